@@ -1,12 +1,28 @@
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import heapq
+import itertools
+import logging
 import os
-from openai import OpenAI
+import time
+from openai import APITimeoutError, AsyncOpenAI
 from dotenv import load_dotenv
 
+import definition_format
+import metrics
+import rate_limit
+
 load_dotenv()
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
+logger = logging.getLogger(__name__)
+
+client = AsyncOpenAI(
+    base_url=os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1"),
     api_key=os.getenv("OPENROUTER_API_KEY"),
+    # Fallback across MODELS replaces the client's own retries
+    max_retries=0,
 )
 
 
@@ -19,59 +35,314 @@ MODELS = [
     "mistralai/mistral-7b-instruct:free",
 ]
 
-def get_definition(word: str) -> str:
-    for model in MODELS:
+# Seconds a single model may take before we move on to the next one
+MODEL_TIMEOUT = float(os.getenv("AI_MODEL_TIMEOUT", "20"))
+# Hedged mode: if no model has answered within this many seconds, also ask
+# the next one and keep the first answer (0 disables hedging)
+HEDGE_DELAY = float(os.getenv("AI_HEDGE_DELAY", "0"))
+# Model requests in flight at once in this process; interactive lookups get free slots first
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+# Lookup priorities, lower goes first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+NOT_FOUND_MESSAGE = "Sorry, I couldn't find a definition for that word right now. Please try again later."
+
+SYSTEM_PROMPT = (
+    "You are a dictionary bot. "
+    "Answer with a single JSON object and nothing else:\n"
+    '{"language": "en" or "ru", "pronunciation": "/IPA/" or null, "definition": "...", "example": "..."}\n'
+    "RULES:\n"
+    "1. language is the language of the input word.\n"
+    "2. If the input word is Russian, you MUST:\n"
+    "   - Write the definition and the example in Russian\n"
+    "   - Set pronunciation to null\n"
+    "3. If the input word is English, you MUST:\n"
+    "   - Give the IPA pronunciation between slashes, e.g. /ˈwɜːrd/\n"
+    "   - Write the definition in RUSSIAN language\n"
+    "   - Write the example sentence in ENGLISH language\n"
+    "4. Plain text in every field: no Markdown, no line breaks.\n"
+)
+
+# Cached definitions are only reused while the prompt and model list stay the same
+PROMPT_VERSION = hashlib.sha1("\n".join([SYSTEM_PROMPT, *MODELS]).encode("utf-8")).hexdigest()[:12]
+
+
+class DefinitionUnavailable(Exception):
+    """Raised when none of the models returned a definition"""
+
+
+class BudgetExhausted(DefinitionUnavailable):
+    """Raised when the global LLM budget allows no more lookups for now"""
+
+    def __init__(self, word, retry_after):
+        super().__init__(word)
+        self.retry_after = retry_after
+
+
+class PrioritySemaphore:
+    """A semaphore that wakes waiters by priority (lower first), then in arrival order"""
+
+    def __init__(self, value):
+        self._value = value
+        self._waiters = []
+        self._order = itertools.count()
+
+    async def acquire(self, priority):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
         try:
-            print(f"Trying model: {model}...")
-            completion = client.chat.completions.create(
-                extra_headers={
-                    "HTTP-Referer": "https://telegram-bot-app.com",
-                    "X-Title": "WordDefinitionBot",
-                },
-                model=model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are a dictionary bot. "
-                            "RULES:\n"
-                            "1. If the input word is Russian, you MUST:\n"
-                            "   - Output everything in Russian\n"
-                            "   - DO NOT include Pronunciation section\n"
-                            "   - Provide only Definition and Context (example)\n"
-                            "2. If the input word is English, you MUST:\n"
-                            "   - Provide IPA pronunciation in format: Pronunciation: /ˈwɜːrd/\n"
-                            "   - Provide the Definition in RUSSIAN language\n"
-                            "   - Provide the Context (example) in ENGLISH language\n"
-                            "3. Format clearly with EMPTY LINES between sections:\n"
-                            "\n"
-                            "For Russian words:\n"
-                            "Определение: ...\n"
-                            "\n"
-                            "Пример употребления: ...\n"
-                            "\n"
-                            "For English words:\n"
-                            "Pronunciation: /.../ \n"
-                            "\n"
-                            "Definition: ...\n"
-                            "\n"
-                            "Context: ...\n"
-                        )
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Word: '{word}'"
-                    }
-                ]
-            )
-            content = completion.choices[0].message.content
-            if not content or content.strip() == "":
-                print(f"Model {model} returned empty content.")
+            await future
+        except asyncio.CancelledError:
+            # Cancelled right after being handed the slot: pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            # Cancelled waiters are skipped here instead of being searched for
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+_slots = PrioritySemaphore(LLM_MAX_CONCURRENCY)
+_priority = contextvars.ContextVar("llm_priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level):
+    """Model requests started inside (also from tasks created inside) wait for slots with this priority"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+@contextlib.asynccontextmanager
+async def _slot():
+    level = _priority.get()
+    started = time.perf_counter()
+    await _slots.acquire(level)
+    metrics.LLM_SLOT_WAIT_SECONDS.labels("interactive" if level == INTERACTIVE else "background").observe(
+        time.perf_counter() - started
+    )
+    try:
+        yield
+    finally:
+        _slots.release()
+
+
+async def _check_budget(word):
+    wait = await rate_limit.take_llm_budget()
+    if wait:
+        metrics.LLM_BUDGET_REJECTED.inc()
+        raise BudgetExhausted(word, wait)
+
+
+def _request(model: str, word: str, **options):
+    return client.chat.completions.create(
+        extra_headers={
+            "HTTP-Referer": "https://telegram-bot-app.com",
+            "X-Title": "WordDefinitionBot",
+        },
+        model=model,
+        messages=[
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": f"Word: '{word}'"
+            }
+        ],
+        # Models that ignore it are still checked by definition_format.parse
+        response_format={"type": "json_object"},
+        timeout=MODEL_TIMEOUT,
+        **options,
+    )
+
+
+def _outcome(error):
+    # Our own wait_for or the client's timeout=MODEL_TIMEOUT, whichever fires first
+    return "timeout" if isinstance(error, (asyncio.TimeoutError, APITimeoutError)) else "error"
+
+
+async def _ask_model(model: str, word: str) -> dict:
+    logger.debug("Trying model: %s", model)
+    # The wait for a slot does not count towards MODEL_TIMEOUT
+    async with _slot():
+        started = time.perf_counter()
+        try:
+            completion = await asyncio.wait_for(_request(model, word), timeout=MODEL_TIMEOUT)
+        except BaseException as e:
+            metrics.observe_llm(model, "cancelled" if isinstance(e, asyncio.CancelledError) else _outcome(e),
+                                time.perf_counter() - started)
+            raise
+    content = completion.choices[0].message.content
+    if not content or content.strip() == "":
+        metrics.observe_llm(model, "empty", time.perf_counter() - started, completion.usage)
+        raise ValueError(f"Model {model} returned empty content.")
+    try:
+        entry = definition_format.parse(content)
+    except ValueError as e:
+        # Rejected before anything is stored; the next model gets a chance
+        metrics.observe_llm(model, "invalid", time.perf_counter() - started, completion.usage)
+        raise ValueError(f"Model {model} returned a malformed definition: {e}") from None
+    metrics.observe_llm(model, "ok", time.perf_counter() - started, completion.usage)
+    return entry
+
+
+async def _fetch_sequential(word: str, models) -> dict:
+    for model in models:
+        try:
+            return await _ask_model(model, word)
+        except asyncio.TimeoutError:
+            logger.warning("Error with %s: timed out after %ss", model, MODEL_TIMEOUT)
+        except Exception as e:
+            logger.warning("Error with %s: %s", model, e)
+        metrics.observe_fallback(model)
+    raise DefinitionUnavailable(word)
+
+
+async def _fetch_hedged(word: str, models, hedge_delay: float) -> dict:
+    remaining = iter(models)
+    pending = set()
+
+    def launch_next():
+        model = next(remaining, None)
+        if model is None:
+            return False
+        pending.add(asyncio.create_task(_ask_model(model, word), name=model))
+        return True
+
+    launch_next()
+    delay = hedge_delay
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Nobody answered within the latency budget, hedge with the next model
+                if not launch_next():
+                    delay = None
                 continue
-                
-            return content
+
+            for task in done:
+                pending.discard(task)
+                error = task.exception()
+                if error is None:
+                    return task.result()
+                if isinstance(error, asyncio.TimeoutError):
+                    error = f"timed out after {MODEL_TIMEOUT}s"
+                logger.warning("Error with %s: %s", task.get_name(), error)
+                metrics.observe_fallback(task.get_name())
+
+            # Replace failed models right away instead of waiting out the budget
+            if not launch_next() and not pending:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+    raise DefinitionUnavailable(word)
+
+
+async def fetch_definition(word: str, hedge_delay: float = None, models=None) -> dict:
+    """
+    Ask MODELS (or the given models) for a definition, a validated definition_format
+    entry. Raises DefinitionUnavailable if all of them fail and BudgetExhausted if
+    the global budget is used up.
+    """
+    await _check_budget(word)
+    if hedge_delay is None:
+        hedge_delay = HEDGE_DELAY
+    if models is None:
+        models = MODELS
+    if hedge_delay > 0:
+        return await _fetch_hedged(word, models, hedge_delay)
+    return await _fetch_sequential(word, models)
+
+
+async def _read_stream(model: str, word: str, progress, changed):
+    """Read a model's streamed answer into progress["text"], holding an LLM slot only while reading"""
+    async with _slot():
+        progress["started"] = time.perf_counter()
+        # MODEL_TIMEOUT bounds the wait for the first chunk and the gaps between chunks
+        stream = await asyncio.wait_for(_request(model, word, stream=True), timeout=MODEL_TIMEOUT)
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                progress["text"] += delta
+                changed.set()
+
+
+async def stream_definition(word: str, models=None):
+    """
+    Yield the definition generated so far as a partial definition_format entry,
+    growing with every chunk, and finally the validated entry.
+
+    Models are tried in order until one finishes a valid answer. If a model
+    fails halfway, the next one starts over, so the entry yielded may get
+    shorter. Raises DefinitionUnavailable if none of them answers and
+    BudgetExhausted if the global budget is used up.
+    """
+    await _check_budget(word)
+    for model in models or MODELS:
+        logger.debug("Trying model (streaming): %s", model)
+        progress = {"text": "", "started": time.perf_counter()}
+        changed = asyncio.Event()
+        reader = asyncio.create_task(_read_stream(model, word, progress, changed))
+        reader.add_done_callback(lambda _: changed.set())
+        try:
+            # The reader holds the LLM slot, not the caller: while the caller is busy with
+            # what was yielded (e.g. editing a message) the reader keeps going and later
+            # yields skip straight to the text read so far
+            while not reader.done():
+                await changed.wait()
+                changed.clear()
+                if progress["text"] and not reader.done():
+                    yield definition_format.parse_partial(progress["text"])
+            reader.result()
         except Exception as e:
-            print(f"Error with {model}: {e}")
+            metrics.observe_llm(model, _outcome(e), time.perf_counter() - progress["started"])
+            metrics.observe_fallback(model)
+            if isinstance(e, asyncio.TimeoutError):
+                logger.warning("Error with %s: timed out after %ss", model, MODEL_TIMEOUT)
+            else:
+                logger.warning("Error with %s: %s", model, e)
+            continue
+        finally:
+            reader.cancel()
+        text, started = progress["text"], progress["started"]
+        if not text.strip():
+            metrics.observe_llm(model, "empty", time.perf_counter() - started)
+            metrics.observe_fallback(model)
+            logger.warning("Error with %s: Model %s returned empty content.", model, model)
+            continue
+        try:
+            entry = definition_format.parse(text)
+        except ValueError as e:
+            metrics.observe_llm(model, "invalid", time.perf_counter() - started)
+            metrics.observe_fallback(model)
+            logger.warning("Error with %s: Model %s returned a malformed definition: %s", model, model, e)
             continue
-            
-    return "Sorry, I couldn't find a definition for that word right now. Please try again later."
+        metrics.observe_llm(model, "ok", time.perf_counter() - started)
+        yield entry
+        return
+    raise DefinitionUnavailable(word)
+
+
+async def get_definition(word: str) -> str:
+    """The definition as Markdown message text, or NOT_FOUND_MESSAGE"""
+    try:
+        return definition_format.render(await fetch_definition(word))
+    except DefinitionUnavailable:
+        return NOT_FOUND_MESSAGE
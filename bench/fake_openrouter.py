@@ -0,0 +1,129 @@
+"""
+Local stand-in for the OpenRouter chat completions API.
+
+Answers every request with a canned JSON definition after a configurable delay
+and fails a configurable share of requests with HTTP 500, so the bot's
+timeouts, fallbacks and caches can be exercised without spending credits.
+Streaming requests get the definition word by word as server-sent events.
+
+    python3 -m bench.fake_openrouter --port 8090 --latency 0.8 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+DEFINITION = {
+    "language": "en",
+    "pronunciation": "/ˈwɜːrd/",
+    "definition": "слово, используемое только для нагрузочного тестирования бота",
+    "example": "The benchmark sent this word to see how fast the bot answers.",
+}
+
+
+class FakeOpenRouter:
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0, seed=None, token_interval=0.02):
+        # Mean delay in seconds, plus exponentially distributed jitter with the given mean
+        self.latency = latency
+        self.jitter = jitter
+        # Seconds between streamed chunks (the delay above is the time to the first one)
+        self.token_interval = token_interval
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self._runner = None
+
+    def _delay(self):
+        jitter = self.random.expovariate(1 / self.jitter) if self.jitter > 0 else 0
+        return self.latency + jitter
+
+    async def chat_completions(self, request):
+        payload = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self._delay())
+
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "Simulated upstream failure", "code": 500}}, status=500)
+
+        word = payload["messages"][-1]["content"]
+        content = json.dumps(dict(DEFINITION, definition=f"{DEFINITION['definition']} ({word})"), ensure_ascii=False)
+        if payload.get("stream"):
+            return await self._stream(request, payload, content)
+
+        return web.json_response({
+            "id": f"gen-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 250, "completion_tokens": 60, "total_tokens": 310},
+        })
+
+    async def _stream(self, request, payload, content):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def event(delta, finish_reason=None):
+            chunk = {
+                "id": f"gen-{self.requests}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": payload.get("model", "fake"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+        for idx, piece in enumerate(content.split(" ")):
+            if idx:
+                await asyncio.sleep(self.token_interval)
+            await response.write(event({"content": piece if idx == 0 else " " + piece}))
+        await response.write(event({}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/api/v1/chat/completions", self.chat_completions)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving, return the base URL to use as OPENROUTER_BASE_URL"""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = self._runner.addresses[0][1]
+        return f"http://{host}:{bound_port}/api/v1"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenRouter server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.5, help="base response time, seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="mean extra random delay, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with HTTP 500")
+    args = parser.parse_args()
+
+    server = FakeOpenRouter(args.latency, args.jitter, args.error_rate)
+    print(f"Fake OpenRouter on http://{args.host}:{args.port}/api/v1")
+    web.run_app(server.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+In-process stand-in for the Telegram Bot API.
+
+FakeTelegramRequest plugs into telegram.Bot as its request backend, so the
+real handlers run unchanged: replies, edits and callback answers are
+answered locally and remembered per chat instead of going over the network.
+Synthetic incoming updates are built with make_message_update and
+make_callback_update.
+"""
+import asyncio
+import itertools
+import json
+import time
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "BenchBot", "username": "bench_bot"}
+
+
+class FakeTelegramRequest(BaseRequest):
+    def __init__(self, latency=0.0):
+        # Simulated Bot API round-trip in seconds
+        self.latency = latency
+        self.calls = 0
+        self._message_ids = itertools.count(1)
+        # Last inline keyboard shown in each chat, so scenarios can "press" its buttons
+        self.last_markup = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def _message(self, chat_id, text=None, reply_markup=None):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if text is not None:
+            message["text"] = text
+        if reply_markup:
+            message["reply_markup"] = reply_markup
+            self.last_markup[chat_id] = reply_markup
+        return message
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        reply_markup = params.get("reply_markup")
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = self._message(int(params.get("chat_id", 0)), params.get("text"), reply_markup)
+        elif endpoint == "sendDocument":
+            result = self._message(int(params.get("chat_id", 0)))
+        else:
+            # answerCallbackQuery, deleteMessage, setMyCommands, ...
+            result = True
+
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+    def callback_data(self, chat_id, prefix=None):
+        """callback_data of the first button in the chat's last keyboard matching prefix"""
+        markup = self.last_markup.get(chat_id)
+        if not markup:
+            return None
+        for row in markup.get("inline_keyboard", []):
+            for button in row:
+                data = button.get("callback_data")
+                if data and (prefix is None or data.startswith(prefix)):
+                    return data
+        return None
+
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1_000_000)
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def make_message_update(user_id, text):
+    """Update dict for a private text message (commands get their entity)"""
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def make_callback_update(user_id, data):
+    """Update dict for an inline button press on a bot message"""
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_message_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(_message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "card",
+            },
+        },
+    }
@@ -1,205 +1,791 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import asyncpg
 from datetime import datetime
 import os
 
+import metrics
+import migrations
+
 # Get DATABASE_URL from environment (Railway provides this automatically)
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-def get_connection():
-    """Create a connection to PostgreSQL database"""
+# Connection pool settings
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Seconds to wait for a free connection before giving up
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+# Seconds a single query may run
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+# Prepared statements cached per connection (set to 0 behind pgbouncer in transaction mode)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+_pool = None
+
+async def create_pool(**options):
+    """Create the shared PostgreSQL connection pool (extra options go to asyncpg.create_pool)"""
+    global _pool
     if not DATABASE_URL:
         raise ValueError(
             "DATABASE_URL не установлена! "
             "Добавьте переменную окружения DATABASE_URL в Railway.\n"
             "Инструкция: https://github.com/nevatas/wordmeaning/blob/main/RAILWAY_SETUP.md"
         )
-    conn = psycopg2.connect(DATABASE_URL)
-    return conn
-
-def init_db():
-    """Initialize database tables"""
-    conn = get_connection()
-    c = conn.cursor()
-    
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            **options,
+        )
+    return _pool
+
+async def close_pool():
+    """Close all pooled connections"""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+def get_connection():
+    """Acquire a pooled connection, use as `async with get_connection() as conn`"""
+    if _pool is None:
+        raise RuntimeError("Database pool is not initialized, call init_db() first")
+    return _pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+
+async def connect():
+    """Open a dedicated connection outside the pool (for LISTEN and session-level locks)"""
+    if not DATABASE_URL:
+        raise ValueError("DATABASE_URL не установлена!")
+    return await asyncpg.connect(DATABASE_URL, command_timeout=DB_COMMAND_TIMEOUT)
+
+def _affected_rows(status):
+    """Extract the row count from a command status like 'DELETE 3'"""
     try:
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id BIGINT PRIMARY KEY,
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        return int(status.split()[-1])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+async def init_db():
+    """Create the connection pool and bring the schema up to date"""
+    await create_pool()
+    async with get_connection() as conn:
+        await migrations.migrate(conn)
+
+async def add_user(user_id):
+    """Add a new user or ignore if exists"""
+    async with get_connection() as conn:
+        await conn.execute('INSERT INTO users (id) VALUES ($1) ON CONFLICT (id) DO NOTHING', user_id)
+
+async def get_user_settings(user_id):
+    """A user's settings as JSON text, or None if the user is unknown"""
+    async with get_connection() as conn:
+        return await conn.fetchval('SELECT settings::text FROM users WHERE id = $1', user_id)
+
+async def update_user_settings(user_id, changes):
+    """Merge a JSON object into a user's settings (adding the user if needed), return the new settings"""
+    async with get_connection() as conn:
+        return await conn.fetchval('''
+            INSERT INTO users (id, settings) VALUES ($1, $2::jsonb)
+            ON CONFLICT (id) DO UPDATE SET settings = users.settings || EXCLUDED.settings
+            RETURNING settings::text
+        ''', user_id, changes)
+
+async def claim_reminders(now, reminded_before, after_id, limit, max_due):
+    """
+    Claim up to limit users with ids above after_id (None to start over) who
+    have words due by now, were last reminded before reminded_before and have
+    reminders on; their last_reminded_at becomes now. Returns (id, due) with
+    due counted up to max_due. Users claimed by another process are skipped.
+    """
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            UPDATE users u SET last_reminded_at = $1
+            FROM (
+                SELECT candidate.id, due.count AS due
+                FROM users candidate
+                CROSS JOIN LATERAL (
+                    SELECT COUNT(*) FROM (
+                        SELECT 1 FROM words w
+                        WHERE w.user_id = candidate.id AND w.next_review_at <= $1
+                        LIMIT $5
+                    ) capped
+                ) due
+                WHERE candidate.id > COALESCE($3::bigint, -1)
+                  AND (candidate.last_reminded_at IS NULL OR candidate.last_reminded_at < $2)
+                  AND COALESCE((candidate.settings->>'reminders')::boolean, TRUE)
+                  AND due.count > 0
+                ORDER BY candidate.id
+                LIMIT $4
+                FOR UPDATE OF candidate SKIP LOCKED
+            ) claimed
+            WHERE u.id = claimed.id
+            RETURNING u.id, claimed.due
+        ''', now, reminded_before, after_id, limit, max_due)
+
+async def add_word(user_id, word, definition, next_review_at, definition_id=None, details=None):
+    """
+    Add a new word to user's vocabulary, return its ID. A word the user already has
+    gets the new definition only if it is a real one (has a definition_id): a
+    placeholder never replaces a definition the word already has.
+    details is the JSON text of a structured definition's other fields, see definition_format.
+    Adds the user in the same statement, so no add_user call is needed first.
+    """
+    async with get_connection() as conn:
+        return await conn.fetchval('''
+            WITH new_user AS (
+                INSERT INTO users (id) VALUES ($1) ON CONFLICT (id) DO NOTHING
+            ),
+            saved AS (
+                INSERT INTO words (user_id, word, definition, repetition_level, next_review_at, definition_id, details)
+                VALUES ($1, $2, $3, $4, $5, $6, $7::jsonb)
+                ON CONFLICT (user_id, LOWER(word))
+                DO UPDATE SET definition = EXCLUDED.definition, definition_id = EXCLUDED.definition_id,
+                    details = EXCLUDED.details
+                WHERE EXCLUDED.definition_id IS NOT NULL
+                RETURNING id
             )
-        ''')
-        
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS words (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                word TEXT NOT NULL,
-                definition TEXT,
-                repetition_level INTEGER DEFAULT 0,
-                next_review_at TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(user_id) REFERENCES users(id)
+            SELECT id FROM saved
+            UNION ALL
+            -- The word was already there and kept its definition
+            SELECT id FROM words
+            WHERE user_id = $1 AND LOWER(word) = LOWER($2) AND NOT EXISTS (SELECT 1 FROM saved)
+        ''', user_id, word, definition, 0, next_review_at, definition_id, details)
+
+async def add_words(user_id, words, next_review_at):
+    """
+    Add many new words in one statement, together with the user if needed.
+    words are (word, definition, definition_id, details); words the user already
+    has are skipped. Returns (id, word, definition_id) of the inserted rows.
+    """
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            WITH new_user AS (
+                INSERT INTO users (id) VALUES ($1) ON CONFLICT (id) DO NOTHING
             )
-        ''')
-        
-        conn.commit()
-    finally:
-        c.close()
-        conn.close()
-
-def add_user(user_id):
-    """Add a new user or ignore if exists"""
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        c.execute('INSERT INTO users (id) VALUES (%s) ON CONFLICT (id) DO NOTHING', (user_id,))
-        conn.commit()
-    finally:
-        c.close()
-        conn.close()
-
-def add_word(user_id, word, definition, next_review_at):
-    """Add a new word to user's vocabulary"""
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        c.execute('''
-            INSERT INTO words (user_id, word, definition, repetition_level, next_review_at)
-            VALUES (%s, %s, %s, %s, %s)
-        ''', (user_id, word, definition, 0, next_review_at))
-        conn.commit()
-    finally:
-        c.close()
-        conn.close()
-
-def get_due_words(user_id):
-    """Get all words that are due for review"""
-    conn = get_connection()
-    c = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        now = datetime.now()
-        c.execute('''
-            SELECT * FROM words 
-            WHERE user_id = %s AND next_review_at <= %s
+            INSERT INTO words (user_id, word, definition, repetition_level, next_review_at, definition_id, details)
+            SELECT $1, w.word, w.definition, 0, $5, w.definition_id, w.details::jsonb
+            FROM UNNEST($2::text[], $3::text[], $4::int[], $6::text[]) AS w(word, definition, definition_id, details)
+            ON CONFLICT (user_id, LOWER(word)) DO NOTHING
+            RETURNING id, word, definition_id
+        ''', user_id, [w[0] for w in words], [w[1] for w in words], [w[2] for w in words], next_review_at,
+            [w[3] for w in words])
+
+async def get_existing_words(user_id, words):
+    """Lowercased forms of the given words that the user already has"""
+    async with get_connection() as conn:
+        rows = await conn.fetch('''
+            SELECT LOWER(word) AS word FROM words
+            WHERE user_id = $1 AND LOWER(word) = ANY($2::text[])
+        ''', user_id, [w.lower() for w in words])
+        return {row['word'] for row in rows}
+
+async def get_cached_definition(word_key, prompt_version):
+    """Get a shared definition by normalized word"""
+    async with get_connection() as conn:
+        return await conn.fetchrow('''
+            SELECT id, definition, details::text FROM definitions
+            WHERE word_key = $1 AND prompt_version = $2
+        ''', word_key, prompt_version)
+
+async def get_cached_definitions(word_keys, prompt_version):
+    """Shared definitions for many normalized words at once"""
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            SELECT id, word_key, definition, details::text FROM definitions
+            WHERE word_key = ANY($1::text[]) AND prompt_version = $2
+        ''', list(word_keys), prompt_version)
+
+async def save_cached_definition(word_key, prompt_version, definition, details=None):
+    """Store a shared definition and return its row (keeps the existing one on conflict)"""
+    async with get_connection() as conn:
+        return await conn.fetchrow('''
+            INSERT INTO definitions (word_key, prompt_version, definition, details)
+            VALUES ($1, $2, $3, $4::jsonb)
+            ON CONFLICT (word_key, prompt_version)
+            DO UPDATE SET word_key = EXCLUDED.word_key
+            RETURNING id, definition, details::text
+        ''', word_key, prompt_version, definition, details)
+
+async def get_due_batch(user_id, limit):
+    """Get the most overdue words with what a review card needs (definitions are fetched when shown)"""
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            SELECT id, word, repetition_level, ease, stability, difficulty, lapses,
+                last_review_at, next_review_at
+            FROM words
+            WHERE user_id = $1 AND next_review_at <= $2
             ORDER BY next_review_at ASC
-        ''', (user_id, now))
-        return c.fetchall()
-    finally:
-        c.close()
-        conn.close()
-
-def get_word(word_id):
-    """Get a specific word by ID"""
-    conn = get_connection()
-    c = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        c.execute('SELECT * FROM words WHERE id = %s', (word_id,))
-        return c.fetchone()
-    finally:
-        c.close()
-        conn.close()
-
-def update_word_progress(word_id, new_level, next_review_at):
-    """Update word's repetition progress"""
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        c.execute('''
-            UPDATE words 
-            SET repetition_level = %s, next_review_at = %s
-            WHERE id = %s
-        ''', (new_level, next_review_at, word_id))
-        conn.commit()
-    finally:
-        c.close()
-        conn.close()
-
-def get_all_user_words(user_id):
-    """Get all words for a user"""
-    conn = get_connection()
-    c = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        c.execute('''
-            SELECT * FROM words 
-            WHERE user_id = %s
+            LIMIT $3
+        ''', user_id, datetime.now(), limit)
+
+async def count_due_words(user_id):
+    """Count words that are due for review"""
+    async with get_connection() as conn:
+        return await conn.fetchval('''
+            SELECT COUNT(*) FROM words
+            WHERE user_id = $1 AND next_review_at <= $2
+        ''', user_id, datetime.now())
+
+async def buffer_review_answer(user_id, answer):
+    """
+    Store one answer until flush_review_answers applies it. The answer is a dict
+    with the word's id and the new scheduling state: level, ease, stability,
+    difficulty, lapses, last_review_at and next_review_at, plus what goes into
+    the review log: grade, scheduler, elapsed_days, prior_interval and stability_before.
+    """
+    async with get_connection() as conn:
+        await conn.execute('''
+            INSERT INTO review_answer_buffer (
+                user_id, word_id, level, ease, stability, difficulty, lapses, last_review_at, next_review_at,
+                grade, scheduler, elapsed_days, prior_interval, stability_before
+            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14)
+        ''', user_id, answer['id'], answer['level'], answer['ease'], answer['stability'], answer['difficulty'],
+            answer['lapses'], answer['last_review_at'], answer['next_review_at'], answer['grade'],
+            answer['scheduler'], answer['elapsed_days'], answer['prior_interval'], answer['stability_before'])
+
+async def flush_review_answers(user_id):
+    """
+    Apply a user's buffered answers to words and the review log in one statement
+    and return how many there were. The buffer rows are taken with DELETE, so
+    concurrent flushes from several processes never apply an answer twice.
+    """
+    async with get_connection() as conn:
+        return await conn.fetchval('''
+            WITH taken AS (
+                DELETE FROM review_answer_buffer WHERE user_id = $1
+                RETURNING *
+            ),
+            -- A word answered twice keeps its last state, the log keeps every answer
+            latest AS (
+                SELECT DISTINCT ON (word_id) *
+                FROM taken
+                ORDER BY word_id, seq DESC
+            ),
+            updated AS (
+                UPDATE words
+                SET repetition_level = a.level,
+                    ease = a.ease,
+                    stability = a.stability,
+                    difficulty = a.difficulty,
+                    lapses = a.lapses,
+                    last_review_at = a.last_review_at,
+                    next_review_at = a.next_review_at
+                FROM latest a
+                WHERE words.id = a.word_id AND words.user_id = $1
+                RETURNING words.id
+            ),
+            logged AS (
+                INSERT INTO review_log (
+                    user_id, word_id, reviewed_at, grade, scheduler, elapsed_days, prior_interval, stability_before
+                )
+                SELECT $1, l.word_id, l.last_review_at, l.grade, l.scheduler, l.elapsed_days, l.prior_interval,
+                    l.stability_before
+                FROM taken l
+                WHERE l.word_id IN (SELECT id FROM updated)
+            )
+            SELECT count(*) FROM taken
+        ''', user_id)
+
+async def get_buffered_review_users():
+    """IDs of users with buffered answers, including ones left by a process that died"""
+    async with get_connection() as conn:
+        return [row['user_id'] for row in await conn.fetch('SELECT DISTINCT user_id FROM review_answer_buffer')]
+
+async def ensure_review_log_partitions(now, months_ahead=2):
+    """Create the monthly review_log partitions from this month to months_ahead months later"""
+    month = datetime(now.year, now.month, 1)
+    async with get_connection() as conn:
+        for _ in range(months_ahead + 1):
+            following = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+            # Partition bounds cannot be parameters; both are dates formatted here
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS review_log_{month:%Y_%m} PARTITION OF review_log "
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+            )
+            month = following
+
+async def get_word(word_id):
+    """Get a specific word by ID with its owner and scheduling state (without the definition)"""
+    async with get_connection() as conn:
+        return await conn.fetchrow('''
+            SELECT id, user_id, word, repetition_level, ease, stability, difficulty, lapses,
+                last_review_at, next_review_at
+            FROM words WHERE id = $1
+        ''', word_id)
+
+async def get_word_definition(user_id, word_id):
+    """The definition and details (JSON text) of one of a user's words"""
+    async with get_connection() as conn:
+        return await conn.fetchrow(
+            'SELECT definition, details::text FROM words WHERE id = $1 AND user_id = $2',
+            word_id, user_id
+        )
+
+async def reschedule_words(compute, scheduler, user_id=None, chunk_size=50_000):
+    """
+    Recompute due dates of every reviewed word (or one user's) in one pass.
+
+    Rows are read through a cursor in chunks; compute(rows) gets each chunk
+    (id, repetition_level, ease, stability, difficulty, lapses, last_review_at,
+    stability_scale), the scale being the owner's own fit for the named
+    scheduler from scheduler_params or None, and returns (id, last_review_at, next_review_at) tuples. They are COPYed into
+    a temporary table and applied with a single UPDATE, skipping words answered
+    in the meantime. Returns how many words got a new due date.
+    """
+    async with get_connection() as conn:
+        async with conn.transaction():
+            await conn.execute('''
+                CREATE TEMPORARY TABLE rescheduled (
+                    id INTEGER PRIMARY KEY,
+                    last_review_at TIMESTAMP,
+                    next_review_at TIMESTAMP
+                ) ON COMMIT DROP
+            ''')
+            await conn.execute('''
+                DECLARE reschedule_cursor NO SCROLL CURSOR FOR
+                SELECT w.id, w.repetition_level, w.ease, w.stability, w.difficulty, w.lapses, w.last_review_at,
+                    (p.params->>'stability_scale')::float8 AS stability_scale
+                FROM words w
+                LEFT JOIN scheduler_params p ON p.scheduler = $2 AND p.user_id = w.user_id
+                WHERE w.last_review_at IS NOT NULL AND ($1::BIGINT IS NULL OR w.user_id = $1)
+            ''', user_id, scheduler)
+            while True:
+                rows = await conn.fetch(f'FETCH {int(chunk_size)} FROM reschedule_cursor')
+                if not rows:
+                    break
+                await conn.copy_records_to_table(
+                    'rescheduled', records=compute(rows),
+                    columns=['id', 'last_review_at', 'next_review_at'],
+                )
+            await conn.execute('CLOSE reschedule_cursor')
+            status = await conn.execute('''
+                UPDATE words
+                SET next_review_at = r.next_review_at
+                FROM rescheduled r
+                WHERE words.id = r.id
+                    AND words.last_review_at = r.last_review_at
+                    AND words.next_review_at IS DISTINCT FROM r.next_review_at
+            ''')
+            return _affected_rows(status)
+
+async def get_all_user_words(user_id):
+    """Get ids and words of all of a user's words, newest first"""
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            SELECT id, word FROM words
+            WHERE user_id = $1
             ORDER BY created_at DESC
-        ''', (user_id,))
-        return c.fetchall()
-    finally:
-        c.close()
-        conn.close()
-
-def delete_word_by_id(word_id):
-    """Delete a word by its ID"""
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        c.execute('DELETE FROM words WHERE id = %s', (word_id,))
-        conn.commit()
-        return c.rowcount > 0
-    finally:
-        c.close()
-        conn.close()
-
-def delete_word_by_text(user_id, word_text):
-    """Delete a word by its text content"""
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        c.execute('DELETE FROM words WHERE user_id = %s AND word = %s', (user_id, word_text))
-        conn.commit()
-        return c.rowcount > 0
-    finally:
-        c.close()
-        conn.close()
-
-def search_word_exact(user_id, word_text):
-    """Search for exact word match"""
-    conn = get_connection()
-    c = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        c.execute('''
-            SELECT * FROM words 
-            WHERE user_id = %s AND LOWER(word) = LOWER(%s)
-        ''', (user_id, word_text))
-        return c.fetchall()
-    finally:
-        c.close()
-        conn.close()
-
-def search_word_partial(user_id, word_text):
-    """Search for partial word match"""
-    conn = get_connection()
-    c = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        c.execute('''
-            SELECT * FROM words 
-            WHERE user_id = %s AND LOWER(word) LIKE LOWER(%s)
-            ORDER BY word ASC
-            LIMIT 10
-        ''', (user_id, f'%{word_text}%'))
-        return c.fetchall()
-    finally:
-        c.close()
-        conn.close()
-
-def get_user_stats(user_id):
-    """Get statistics for a user"""
-    conn = get_connection()
-    c = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        c.execute('''
-            SELECT 
-                COUNT(*) as total,
-                COUNT(CASE WHEN repetition_level = 0 THEN 1 END) as new_words,
-                COUNT(CASE WHEN repetition_level BETWEEN 1 AND 2 THEN 1 END) as learning,
-                COUNT(CASE WHEN repetition_level >= 3 THEN 1 END) as mastered,
-                COUNT(CASE WHEN next_review_at <= NOW() THEN 1 END) as due_now
-            FROM words 
-            WHERE user_id = %s
-        ''', (user_id,))
-        return c.fetchone()
-    finally:
-        c.close()
-        conn.close()
+        ''', user_id)
+
+async def iter_user_words(user_id, chunk_size=500):
+    """
+    Yield a user's words in chunks of at most chunk_size rows, oldest first,
+    reading through a server-side cursor so memory use does not grow with the
+    vocabulary. Holds a connection until the iteration ends.
+    """
+    async with get_connection() as conn:
+        async with conn.transaction():
+            cursor = await conn.cursor('''
+                SELECT word, definition, details::text, repetition_level, next_review_at, created_at
+                FROM words
+                WHERE user_id = $1
+                ORDER BY created_at, id
+            ''', user_id)
+            while True:
+                rows = await cursor.fetch(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+async def copy_words_to(output, user_id=None):
+    """COPY every user's words (or one user's) as CSV with a header into a file-like object or path"""
+    async with get_connection() as conn:
+        if user_id is None:
+            query = '''
+                SELECT user_id, word, definition, details, repetition_level, next_review_at, created_at
+                FROM words
+            '''
+            args = ()
+        else:
+            query = '''
+                SELECT user_id, word, definition, details, repetition_level, next_review_at, created_at
+                FROM words
+                WHERE user_id = $1
+            '''
+            args = (user_id,)
+        status = await conn.copy_from_query(query, *args, output=output, format='csv', header=True)
+        return _affected_rows(status)
+
+async def get_words_page(user_id, limit, older_than=None, newer_than=None):
+    """
+    Get one page of a user's words, newest first, using (created_at, id) keyset cursors.
+    Returns (words, has_more) where has_more tells if there are further words in the
+    direction of the request.
+    """
+    async with get_connection() as conn:
+        if newer_than is not None:
+            rows = await conn.fetch('''
+                SELECT id, word, repetition_level, next_review_at, created_at FROM words
+                WHERE user_id = $1 AND (created_at, id) > ($2, $3)
+                ORDER BY created_at ASC, id ASC
+                LIMIT $4
+            ''', user_id, newer_than[0], newer_than[1], limit + 1)
+            has_more = len(rows) > limit
+            return list(reversed(rows[:limit])), has_more
+
+        if older_than is not None:
+            rows = await conn.fetch('''
+                SELECT id, word, repetition_level, next_review_at, created_at FROM words
+                WHERE user_id = $1 AND (created_at, id) < ($2, $3)
+                ORDER BY created_at DESC, id DESC
+                LIMIT $4
+            ''', user_id, older_than[0], older_than[1], limit + 1)
+        else:
+            rows = await conn.fetch('''
+                SELECT id, word, repetition_level, next_review_at, created_at FROM words
+                WHERE user_id = $1
+                ORDER BY created_at DESC, id DESC
+                LIMIT $2
+            ''', user_id, limit + 1)
+        return rows[:limit], len(rows) > limit
+
+async def delete_words_by_ids(user_id, word_ids):
+    """Delete a user's words by id in one statement, return the deleted words"""
+    async with get_connection() as conn:
+        rows = await conn.fetch('''
+            DELETE FROM words
+            WHERE id = ANY($2::int[]) AND user_id = $1
+            RETURNING word
+        ''', user_id, word_ids)
+        return [row['word'] for row in rows]
+
+async def delete_words_by_text(user_id, words):
+    """Delete a user's words by text (case-insensitive) in one statement, return the deleted words"""
+    async with get_connection() as conn:
+        rows = await conn.fetch('''
+            DELETE FROM words
+            WHERE user_id = $1 AND LOWER(word) = ANY($2::text[])
+            RETURNING word
+        ''', user_id, [word.lower() for word in words])
+        return [row['word'] for row in rows]
+
+def _like_pattern(text, prefix='%', suffix='%'):
+    """LIKE pattern matching text literally"""
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'{prefix}{escaped}{suffix}'
+
+async def has_extension(name):
+    """Whether a Postgres extension is installed in the database"""
+    async with get_connection() as conn:
+        return await conn.fetchval('SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = $1)', name)
+
+async def search_words_fuzzy(user_id, term, limit):
+    """
+    Words containing the term or similar to it (pg_trgm), best first: exact match,
+    then prefixes, then by trigram similarity. term must be lowercased.
+    """
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            SELECT id, word, repetition_level, similarity(LOWER(word), $2) AS score
+            FROM words
+            WHERE user_id = $1 AND (LOWER(word) LIKE $3 OR LOWER(word) % $2)
+            ORDER BY LOWER(word) = $2 DESC, LOWER(word) LIKE $4 DESC, score DESC, word
+            LIMIT $5
+        ''', user_id, term, _like_pattern(term), _like_pattern(term, prefix=''), limit)
+
+async def search_definitions(user_id, term, limit):
+    """Words whose definition contains the term (lowercased)"""
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            SELECT id, word, repetition_level
+            FROM words
+            WHERE user_id = $1 AND LOWER(definition) LIKE $2
+            ORDER BY word
+            LIMIT $3
+        ''', user_id, _like_pattern(term), limit)
+
+async def get_search_entries(user_id):
+    """(id, word) of all of a user's words, for the in-memory search index"""
+    async with get_connection() as conn:
+        return await conn.fetch('SELECT id, word FROM words WHERE user_id = $1', user_id)
+
+async def get_words_by_ids(user_id, word_ids):
+    """A user's words with the given ids, in no particular order"""
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            SELECT id, word, repetition_level
+            FROM words
+            WHERE id = ANY($2::int[]) AND user_id = $1
+        ''', user_id, word_ids)
+
+async def get_user_stats(user_id):
+    """Get statistics for a user from the incrementally maintained counters"""
+    async with get_connection() as conn:
+        return await conn.fetchrow('''
+            SELECT
+                COALESCE(s.total, 0) as total,
+                COALESCE(s.new_words, 0) as new_words,
+                COALESCE(s.learning, 0) as learning,
+                COALESCE(s.mastered, 0) as mastered,
+                (
+                    SELECT COUNT(*) FROM words
+                    WHERE user_id = $1 AND next_review_at <= $2
+                ) as due_now
+            FROM (SELECT $1::BIGINT AS user_id) u
+            LEFT JOIN user_stats s ON s.user_id = u.user_id
+        ''', user_id, datetime.now())
+
+async def rebuild_user_stats(user_id=None):
+    """
+    Recount the stats counters from the words table, for one user or everyone.
+    Returns the IDs of users whose counters were wrong.
+    """
+    async with get_connection() as conn:
+        async with conn.transaction():
+            # Writers to words wait on these locks, so nothing changes between counting and saving
+            if user_id is None:
+                await conn.execute('LOCK TABLE user_stats IN SHARE ROW EXCLUSIVE MODE')
+            else:
+                await conn.execute('SELECT 1 FROM user_stats WHERE user_id = $1 FOR UPDATE', user_id)
+
+            rows = await conn.fetch('''
+                INSERT INTO user_stats AS s (user_id, total, new_words, learning, mastered)
+                SELECT
+                    u.id,
+                    COUNT(w.id),
+                    COUNT(w.id) FILTER (WHERE w.repetition_level = 0),
+                    COUNT(w.id) FILTER (WHERE w.repetition_level BETWEEN 1 AND 2),
+                    COUNT(w.id) FILTER (WHERE w.repetition_level >= 3)
+                FROM users u
+                LEFT JOIN words w ON w.user_id = u.id
+                WHERE $1::BIGINT IS NULL OR u.id = $1
+                GROUP BY u.id
+                ON CONFLICT (user_id) DO UPDATE SET
+                    total = EXCLUDED.total,
+                    new_words = EXCLUDED.new_words,
+                    learning = EXCLUDED.learning,
+                    mastered = EXCLUDED.mastered
+                WHERE (s.total, s.new_words, s.learning, s.mastered)
+                    IS DISTINCT FROM (EXCLUDED.total, EXCLUDED.new_words, EXCLUDED.learning, EXCLUDED.mastered)
+                RETURNING s.user_id, s.total, (s.xmax = 0) AS inserted
+            ''', user_id)
+            # A new all-zero row only means the user has no words yet
+            return [row['user_id'] for row in rows if not (row['inserted'] and row['total'] == 0)]
+
+async def enqueue_update(partition, user_id, payload):
+    """Append a raw update (JSON text) to the shared queue and wake the worker owning its partition"""
+    async with get_connection() as conn:
+        await conn.execute('''
+            WITH queued AS (
+                INSERT INTO update_queue (partition, user_id, payload)
+                VALUES ($1, $2, $3::jsonb)
+                RETURNING partition
+            )
+            SELECT pg_notify('update_queue', partition::text) FROM queued
+        ''', partition, user_id, payload)
+
+async def fetch_queued_updates(partition, limit, skip_ids=()):
+    """Oldest queued updates of a partition, in arrival order, leaving out skip_ids (ones being handled)"""
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            SELECT id, user_id, payload::text AS payload
+            FROM update_queue
+            WHERE partition = $1 AND id <> ALL($3::bigint[])
+            ORDER BY id
+            LIMIT $2
+        ''', partition, limit, list(skip_ids))
+
+async def delete_queued_updates(update_ids):
+    """Remove handled updates from the shared queue"""
+    async with get_connection() as conn:
+        status = await conn.execute('DELETE FROM update_queue WHERE id = ANY($1::bigint[])', list(update_ids))
+        return _affected_rows(status)
+
+async def load_bot_state(kind, partitions=None):
+    """Saved (key, data) pairs of one kind, optionally only those of the given partitions"""
+    async with get_connection() as conn:
+        return await conn.fetch('''
+            SELECT key, data FROM bot_state
+            WHERE kind = $1 AND ($2::int[] IS NULL OR partition = ANY($2::int[]))
+        ''', kind, partitions)
+
+async def save_bot_state(kind, key, partition, data):
+    """Insert or replace one saved state entry"""
+    async with get_connection() as conn:
+        await conn.execute('''
+            INSERT INTO bot_state (kind, key, partition, data)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (kind, key)
+            DO UPDATE SET partition = EXCLUDED.partition, data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP
+        ''', kind, key, partition, data)
+
+async def delete_bot_state(kind, key):
+    """Forget one saved state entry"""
+    async with get_connection() as conn:
+        await conn.execute('DELETE FROM bot_state WHERE kind = $1 AND key = $2', kind, key)
+
+async def enqueue_definition_job(word_id, word, chat_id, message_id, run_after):
+    """Queue a background lookup for a saved word (restarts it if one is already queued)"""
+    async with get_connection() as conn:
+        await conn.execute('''
+            INSERT INTO definition_jobs (word_id, word, chat_id, message_id, run_after)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (word_id) DO UPDATE SET
+                word = EXCLUDED.word,
+                chat_id = EXCLUDED.chat_id,
+                message_id = EXCLUDED.message_id,
+                attempts = 0,
+                run_after = EXCLUDED.run_after,
+                last_error = NULL
+        ''', word_id, word, chat_id, message_id, run_after)
+
+async def enqueue_definition_jobs(word_ids, words, run_after):
+    """Queue background lookups for many saved words at once"""
+    async with get_connection() as conn:
+        await conn.execute('''
+            INSERT INTO definition_jobs (word_id, word, run_after)
+            SELECT j.word_id, j.word, $3
+            FROM UNNEST($1::int[], $2::text[]) AS j(word_id, word)
+            ON CONFLICT (word_id) DO NOTHING
+        ''', list(word_ids), list(words), run_after)
+
+async def claim_definition_job(now, lease_until):
+    """
+    Take the oldest due job, hiding it from other workers until lease_until.
+    A worker that dies mid-job leaves it to be picked up again after the lease.
+    """
+    async with get_connection() as conn:
+        return await conn.fetchrow('''
+            UPDATE definition_jobs j
+            SET attempts = j.attempts + 1, run_after = $2
+            FROM (
+                SELECT id FROM definition_jobs
+                WHERE run_after <= $1
+                ORDER BY run_after
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            ) due
+            WHERE j.id = due.id
+            RETURNING j.id, j.word_id, j.word, j.chat_id, j.message_id, j.attempts
+        ''', now, lease_until)
+
+async def complete_definition_job(job_id, word_id, definition, definition_id, details=None, placeholder=None):
+    """
+    Store the definition on the word and drop the job. Without a definition_id (the
+    lookup gave up) the word is only changed while it still has the placeholder
+    text, so a definition it already had is kept. Returns the word's definition and
+    details (JSON text) afterwards, or None if the word is gone.
+    """
+    async with get_connection() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow('''
+                UPDATE words SET definition = $2, definition_id = $3, details = $4::jsonb
+                WHERE id = $1 AND ($3::int IS NOT NULL OR definition = $5)
+                RETURNING definition, details::text
+            ''', word_id, definition, definition_id, details, placeholder)
+            if row is None:
+                row = await conn.fetchrow('SELECT definition, details::text FROM words WHERE id = $1', word_id)
+            await conn.execute('DELETE FROM definition_jobs WHERE id = $1', job_id)
+            return row
+
+async def retry_definition_job(job_id, run_after, error, refund_attempt=False):
+    """Put a failed job back for a later attempt; refund_attempt undoes the claim's attempt count"""
+    async with get_connection() as conn:
+        await conn.execute(
+            'UPDATE definition_jobs SET run_after = $2, last_error = $3, attempts = attempts - $4 WHERE id = $1',
+            job_id, run_after, error, 1 if refund_attempt else 0
+        )
+
+async def take_rate_limit_tokens(key, capacity, per_second, cost, now):
+    """
+    Take cost tokens from a shared token bucket that holds at most capacity and
+    refills at per_second. Returns the tokens left, or None if there were not enough.
+    """
+    async with get_connection() as conn:
+        return await conn.fetchval('''
+            INSERT INTO rate_limits AS b (key, tokens, updated_at)
+            VALUES ($1, $2::float8 - $4::float8, $5)
+            ON CONFLICT (key) DO UPDATE
+            SET tokens = LEAST($2::float8, b.tokens + EXTRACT(EPOCH FROM $5 - b.updated_at)::float8 * $3::float8) - $4::float8,
+                updated_at = $5
+            WHERE LEAST($2::float8, b.tokens + EXTRACT(EPOCH FROM $5 - b.updated_at)::float8 * $3::float8) >= $4::float8
+            RETURNING tokens
+        ''', key, capacity, per_second, cost, now)
+
+async def get_definition_job_stats(now):
+    """
+    Queue depth, how many jobs are due and the age of the oldest one in seconds.
+    The counts come from the run_after index and the oldest job is the one with
+    the lowest id (a restarted job keeps its row), so the table itself is not read.
+    """
+    async with get_connection() as conn:
+        return await conn.fetchrow('''
+            SELECT
+                (SELECT COUNT(*) FROM definition_jobs) AS depth,
+                (SELECT COUNT(*) FROM definition_jobs WHERE run_after <= $1) AS due,
+                COALESCE(EXTRACT(EPOCH FROM $1 - (
+                    SELECT created_at FROM definition_jobs ORDER BY id LIMIT 1
+                )), 0) AS oldest_age
+        ''', now)
+
+async def get_update_queue_stats(now):
+    """
+    Upper bound of the shared queue depth (ids are consecutive, but handled
+    updates leave gaps) and the age of the oldest update in seconds, both
+    read from the primary key alone
+    """
+    async with get_connection() as conn:
+        return await conn.fetchrow('''
+            SELECT
+                COALESCE(MAX(id) - MIN(id) + 1, 0) AS depth,
+                COALESCE(EXTRACT(EPOCH FROM $1 - (
+                    SELECT received_at FROM update_queue ORDER BY id LIMIT 1
+                )), 0) AS oldest_age
+            FROM update_queue
+        ''', now)
+
+async def iter_review_log(scheduler, since, chunk_size=50_000):
+    """
+    Yield chunks of logged answers usable for fitting: (user_id, elapsed_days,
+    stability_before, grade) of reviews with a known prior stability since a date
+    """
+    async with get_connection() as conn:
+        async with conn.transaction():
+            cursor = await conn.cursor('''
+                SELECT user_id, elapsed_days, stability_before, grade
+                FROM review_log
+                WHERE scheduler = $1 AND reviewed_at >= $2
+                    AND elapsed_days > 0 AND stability_before > 0
+            ''', scheduler, since)
+            while True:
+                rows = await cursor.fetch(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+async def save_scheduler_params(scheduler, user_id, params, reviews, log_loss, baseline_log_loss):
+    """Store fitted parameters (user_id 0 for the global fit)"""
+    async with get_connection() as conn:
+        await conn.execute('''
+            INSERT INTO scheduler_params (scheduler, user_id, params, reviews, log_loss, baseline_log_loss)
+            VALUES ($1, $2, $3::jsonb, $4, $5, $6)
+            ON CONFLICT (scheduler, user_id) DO UPDATE SET
+                params = EXCLUDED.params,
+                reviews = EXCLUDED.reviews,
+                log_loss = EXCLUDED.log_loss,
+                baseline_log_loss = EXCLUDED.baseline_log_loss,
+                fitted_at = CURRENT_TIMESTAMP
+        ''', scheduler, user_id, params, reviews, log_loss, baseline_log_loss)
+
+async def get_scheduler_params(scheduler, user_id=0):
+    """Fitted parameters as a JSON string, or None"""
+    async with get_connection() as conn:
+        return await conn.fetchval(
+            'SELECT params::text FROM scheduler_params WHERE scheduler = $1 AND user_id = $2',
+            scheduler, user_id
+        )
+
+
+# Latency and row counts of every query function above
+metrics.instrument_queries(globals(), skip={'create_pool', 'close_pool', 'init_db', 'connect'})
@@ -0,0 +1,147 @@
+"""
+Structured definitions.
+
+Models answer with a JSON object that is validated before anything is
+stored:
+
+    {"language": "en", "pronunciation": "/ˈæp.əl/", "definition": "...", "example": "..."}
+
+The definition text goes into the definition column and everything else
+into a small JSONB details column, both in definitions and in words. A
+message is rendered from them only when it is shown, with Markdown
+characters escaped, so model output can no longer break a reply. Words
+saved before definitions were structured, and placeholders such as the
+"pending" text, have no details and are shown as they are.
+"""
+import json
+import re
+
+DETAIL_FIELDS = ("language", "pronunciation", "example")
+LANGUAGES = {"en": "en", "english": "en", "ru": "ru", "russian": "ru"}
+MAX_FIELD_LENGTH = 1000
+
+# "key": "value so far, possibly unterminated
+_PARTIAL_FIELD = re.compile(r'"(\w+)"\s*:\s*"((?:[^"\\]|\\.)*)')
+_MARKDOWN_SPECIAL = re.compile(r'([_*`\[])')
+
+LABELS = {
+    "en": ("Pronunciation", "Definition", "Context"),
+    "ru": (None, "Определение", "Пример употребления"),
+}
+
+
+def _text(data, key, required=False):
+    value = data.get(key)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        if required:
+            raise ValueError(f"'{key}' is missing")
+        return None
+    if not isinstance(value, str):
+        raise ValueError(f"'{key}' is not a string")
+    value = value.strip()
+    if len(value) > MAX_FIELD_LENGTH:
+        raise ValueError(f"'{key}' is too long")
+    return value
+
+
+def parse(text):
+    """A validated definition entry from a model answer; raises ValueError if it is malformed"""
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        raise ValueError("no JSON object in the answer")
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON: {e}") from None
+    if not isinstance(data, dict):
+        raise ValueError("the answer is not a JSON object")
+
+    language = LANGUAGES.get((_text(data, "language") or "").lower())
+    if language is None:
+        raise ValueError(f"unknown language {data.get('language')!r}")
+    pronunciation = _text(data, "pronunciation") if language == "en" else None
+    if pronunciation and not pronunciation.startswith("/"):
+        pronunciation = f"/{pronunciation.strip('/[]')}/"
+    return {
+        "language": language,
+        "pronunciation": pronunciation,
+        "definition": _text(data, "definition", required=True),
+        "example": _text(data, "example"),
+    }
+
+
+def parse_partial(text):
+    """The string fields of a JSON answer that is still being streamed, for progress messages"""
+    entry = {"language": None, "pronunciation": None, "definition": None, "example": None}
+    for key, value in _PARTIAL_FIELD.findall(text):
+        if key not in entry:
+            continue
+        # Cut a trailing half of an escape sequence, then decode the rest
+        value = re.sub(r'\\u?[0-9a-fA-F]{0,3}$|\\$', '', value)
+        try:
+            entry[key] = json.loads(f'"{value}"')
+        except json.JSONDecodeError:
+            entry[key] = value
+    entry["language"] = LANGUAGES.get((entry["language"] or "").lower())
+    return entry
+
+
+def to_columns(entry):
+    """(definition, details as JSON text or None) for storing an entry"""
+    if "language" not in entry:
+        return entry["definition"], None
+    details = {key: entry[key] for key in DETAIL_FIELDS if entry.get(key) is not None}
+    return entry["definition"], json.dumps(details, ensure_ascii=False)
+
+
+def from_columns(definition, details=None):
+    """An entry from stored columns; without details it is free-form text shown as is"""
+    if details is None:
+        return {"definition": definition}
+    data = json.loads(details) if isinstance(details, str) else details
+    entry = {key: data.get(key) for key in DETAIL_FIELDS}
+    entry["definition"] = definition
+    return entry
+
+
+def from_row(row):
+    """An entry from a row with definition and details columns"""
+    return from_columns(row['definition'], row['details'])
+
+
+def escape_markdown(text):
+    """Escape the characters Telegram's Markdown would take as formatting"""
+    return _MARKDOWN_SPECIAL.sub(r'\\\1', text)
+
+
+def bold(text):
+    """
+    Text in bold for Telegram's Markdown. The legacy parser takes no escapes inside
+    an entity, so the special characters are escaped between bold runs instead:
+    well_known becomes *well*\\_*known*.
+    """
+    parts = _MARKDOWN_SPECIAL.split(text)
+    # split() with a group alternates text runs (even) and special characters (odd)
+    return "".join(
+        escape_markdown(part) if i % 2 else f"*{part}*"
+        for i, part in enumerate(parts) if part
+    )
+
+
+def render(entry, markdown=True):
+    """The message text of an entry, in Telegram Markdown or as plain text"""
+    if "language" not in entry:
+        return entry["definition"] or ""
+
+    pronunciation_label, definition_label, example_label = LABELS.get(entry["language"], LABELS["en"])
+    sections = []
+    for label, key in ((pronunciation_label, "pronunciation"), (definition_label, "definition"),
+                       (example_label, "example")):
+        value = entry.get(key)
+        if label is None or not value:
+            continue
+        if markdown:
+            sections.append(f"*{label}:* {escape_markdown(value)}")
+        else:
+            sections.append(f"{label}: {value}")
+    return "\n\n".join(sections)
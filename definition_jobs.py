@@ -0,0 +1,158 @@
+"""
+Background definition lookups.
+
+A word that is not in the definitions cache is saved right away with
+PENDING_DEFINITION and gets a row in definition_jobs. Workers in every bot
+process claim due jobs with FOR UPDATE SKIP LOCKED, ask one model per
+attempt (rotating through ai_client.MODELS), back off exponentially between
+attempts and finally store the definition on the word and edit the user's
+"Defining..." message. Jobs live in PostgreSQL, so they survive restarts: a
+job claimed by a process that died is retried once its lease runs out.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from telegram.error import TelegramError
+
+import ai_client
+import database
+import definition_format
+import definitions
+
+# Lookups running at once in this process
+DEFINITION_WORKERS = int(os.getenv("DEFINITION_WORKERS", "4"))
+# Attempts before giving up on a word (one model per attempt)
+DEFINITION_MAX_ATTEMPTS = int(os.getenv("DEFINITION_MAX_ATTEMPTS", str(len(ai_client.MODELS))))
+# Backoff before attempt n+1 is DEFINITION_RETRY_DELAY * 2**(n-1), capped
+DEFINITION_RETRY_DELAY = float(os.getenv("DEFINITION_RETRY_DELAY", "2"))
+DEFINITION_RETRY_MAX_DELAY = float(os.getenv("DEFINITION_RETRY_MAX_DELAY", "300"))
+# Seconds a claimed job stays hidden from other workers
+DEFINITION_JOB_LEASE = float(os.getenv("DEFINITION_JOB_LEASE", "120"))
+# Seconds between checks for due jobs when nothing woke the workers up
+DEFINITION_POLL_INTERVAL = float(os.getenv("DEFINITION_POLL_INTERVAL", "1"))
+
+PENDING_DEFINITION = "⏳ Определение готовится..."
+
+logger = logging.getLogger(__name__)
+
+_workers = []
+_wakeup = asyncio.Event()
+
+
+def format_saved_word(word, entry):
+    """Markdown reply for a saved word with its definition_format entry"""
+    return f"📖 {definition_format.bold(word)}\n\n{definition_format.render(entry)}\n\n_Word saved to library._"
+
+
+def retry_delay(attempt):
+    return min(DEFINITION_RETRY_MAX_DELAY, DEFINITION_RETRY_DELAY * 2 ** (attempt - 1))
+
+
+def model_for(attempt):
+    return ai_client.MODELS[(attempt - 1) % len(ai_client.MODELS)]
+
+
+async def enqueue(word_id, word, chat_id=None, message_id=None):
+    """Queue a lookup for a saved word; the message, if given, is edited when it is done"""
+    await database.enqueue_definition_job(word_id, word, chat_id, message_id, datetime.now())
+    _wakeup.set()
+
+
+async def enqueue_many(words):
+    """Queue lookups for many saved words, given as (word_id, word), without a message to edit"""
+    if not words:
+        return
+    await database.enqueue_definition_jobs([w[0] for w in words], [w[1] for w in words], datetime.now())
+    _wakeup.set()
+
+
+async def queue_stats():
+    """Depth of the job queue, due jobs and the age of the oldest job in seconds"""
+    row = await database.get_definition_job_stats(datetime.now())
+    return {"depth": row['depth'], "due": row['due'], "oldest_age": float(row['oldest_age'])}
+
+
+async def _run_job(bot, job):
+    attempt = job['attempts']
+    model = model_for(attempt)
+    # Someone is watching the "Defining..." message of a job that has one
+    level = ai_client.INTERACTIVE if job['message_id'] else ai_client.BACKGROUND
+    try:
+        with ai_client.priority(level):
+            definition_id, entry = await definitions.lookup(job['word'], models=[model])
+        error = f"{model} gave no definition"
+    except ai_client.BudgetExhausted as e:
+        # Wait for the budget without using up an attempt
+        run_after = datetime.now() + timedelta(seconds=max(e.retry_after, DEFINITION_POLL_INTERVAL))
+        await database.retry_definition_job(job['id'], run_after, "LLM budget exhausted", refund_attempt=True)
+        return
+    except Exception as e:
+        definition_id, error = None, f"{type(e).__name__}: {e}"
+
+    if definition_id is None:
+        if attempt < DEFINITION_MAX_ATTEMPTS:
+            run_after = datetime.now() + timedelta(seconds=retry_delay(attempt))
+            await database.retry_definition_job(job['id'], run_after, error)
+            return
+        logger.warning("Giving up on '%s' after %s attempts: %s", job['word'], attempt, error)
+        entry = definition_format.from_columns(ai_client.NOT_FOUND_MESSAGE)
+
+    definition, details = definition_format.to_columns(entry)
+    row = await database.complete_definition_job(
+        job['id'], job['word_id'], definition, definition_id, details, placeholder=PENDING_DEFINITION
+    )
+    if row is not None:
+        # On giving up, a word the user already had keeps (and shows) its old definition
+        entry = definition_format.from_row(row)
+
+    if job['chat_id'] and job['message_id']:
+        try:
+            await bot.edit_message_text(
+                format_saved_word(job['word'], entry),
+                chat_id=job['chat_id'],
+                message_id=job['message_id'],
+                parse_mode='Markdown',
+            )
+        except TelegramError as e:
+            # The word is saved either way; the message may be gone or too old to edit
+            logger.warning("Could not update the message for '%s': %s", job['word'], e)
+
+
+async def _worker(bot):
+    while True:
+        try:
+            now = datetime.now()
+            job = await database.claim_definition_job(now, now + timedelta(seconds=DEFINITION_JOB_LEASE))
+        except Exception:
+            logger.exception("Failed to claim a definition job")
+            job = None
+
+        if job is None:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), DEFINITION_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            _wakeup.clear()
+            continue
+
+        try:
+            await _run_job(bot, job)
+        except Exception:
+            # Left claimed, it is retried when the lease expires
+            logger.exception("Definition job %s failed", job['id'])
+
+
+def start(bot):
+    """Start the worker tasks of this process"""
+    for _ in range(DEFINITION_WORKERS - len(_workers)):
+        _workers.append(asyncio.create_task(_worker(bot)))
+
+
+async def stop():
+    """Stop the workers; jobs they were running are retried after their lease"""
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
@@ -0,0 +1,232 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+import ai_client
+import database
+import definition_format
+
+# In-process cache in front of the definitions table
+DEFINITION_CACHE_SIZE = int(os.getenv("DEFINITION_CACHE_SIZE", "10000"))
+DEFINITION_CACHE_TTL = float(os.getenv("DEFINITION_CACHE_TTL", "3600"))
+# Show new definitions while the model writes them instead of after a background job
+DEFINITION_STREAMING = os.getenv("DEFINITION_STREAMING", "false").lower() == "true"
+# Least seconds between two progress callbacks of a streamed definition (Telegram allows about one edit per second per chat)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+
+def normalize_word(word: str) -> str:
+    """Cache key for a word: lowercased with whitespace collapsed"""
+    return " ".join(word.split()).lower()
+
+
+class LRUCache:
+    """Size-bounded LRU mapping whose entries expire after `ttl` seconds"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+_cache = LRUCache(DEFINITION_CACHE_SIZE, DEFINITION_CACHE_TTL)
+
+# Lookups currently waiting on the database or the model, by normalized word
+_in_flight = {}
+
+_counters = {
+    "memory_hits": 0,
+    "db_hits": 0,
+    "misses": 0,
+    "coalesced": 0,
+}
+
+
+def cache_stats():
+    """Hit/miss counters of the definition cache"""
+    return dict(_counters, memory_size=len(_cache))
+
+
+async def cached(word: str):
+    """(definition_id, entry) from the caches, or None without asking the model"""
+    key = normalize_word(word)
+    result = _cache.get(key)
+    if result is not None:
+        _counters["memory_hits"] += 1
+        return result
+    return await _from_db(key)
+
+
+async def cached_many(words):
+    """{normalized word: (definition_id, entry)} for the words found in the caches"""
+    found = {}
+    missing = []
+    for key in dict.fromkeys(normalize_word(word) for word in words):
+        result = _cache.get(key)
+        if result is not None:
+            _counters["memory_hits"] += 1
+            found[key] = result
+        else:
+            missing.append(key)
+
+    if missing:
+        for row in await database.get_cached_definitions(missing, ai_client.PROMPT_VERSION):
+            _counters["db_hits"] += 1
+            result = (row['id'], definition_format.from_row(row))
+            _cache.set(row['word_key'], result)
+            found[row['word_key']] = result
+    return found
+
+
+async def _from_db(key: str):
+    row = await database.get_cached_definition(key, ai_client.PROMPT_VERSION)
+    if not row:
+        return None
+    _counters["db_hits"] += 1
+    result = (row['id'], definition_format.from_row(row))
+    _cache.set(key, result)
+    return result
+
+
+async def lookup(word: str, models=None):
+    """
+    Return (definition_id, entry) for a word, entry being a definition_format
+    entry (render it to show it).
+
+    Checks the in-process cache, then the shared definitions table, and only
+    then asks the model. Both are None when no model could answer, in which
+    case nothing is cached.
+
+    Concurrent lookups of the same normalized word share one in-flight
+    request. A caller that gets cancelled does not cancel it for the others,
+    and an error is delivered to every waiter without being cached.
+    `models` narrows which of ai_client.MODELS are asked on a miss.
+    Raises ai_client.BudgetExhausted when the global LLM budget is used up.
+    """
+    key = normalize_word(word)
+
+    cached = _cache.get(key)
+    if cached is not None:
+        _counters["memory_hits"] += 1
+        return cached
+
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_resolve(key, word, models))
+        _in_flight[key] = future
+        future.add_done_callback(lambda done: _finish(key, done))
+    else:
+        _counters["coalesced"] += 1
+
+    return await asyncio.shield(future)
+
+
+async def lookup_streaming(word: str, on_progress):
+    """
+    Like lookup, but on a miss the definition is streamed from the model and
+    `await on_progress(text)` is called with the plain text rendered so far,
+    at most once per STREAM_EDIT_INTERVAL. The first chunk is reported right away.
+
+    Shares in-flight requests with lookup: concurrent callers of either wait
+    for the one stream and get its final result without progress. Both are
+    None when no model could answer or the LLM budget is used up.
+    """
+    key = normalize_word(word)
+
+    cached = _cache.get(key)
+    if cached is not None:
+        _counters["memory_hits"] += 1
+        return cached
+
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_resolve_streaming(key, word, on_progress))
+        _in_flight[key] = future
+        future.add_done_callback(lambda done: _finish(key, done))
+    else:
+        _counters["coalesced"] += 1
+
+    try:
+        return await asyncio.shield(future)
+    except ai_client.BudgetExhausted:
+        # The caller falls back to a background job, which waits for the budget
+        return None, None
+
+
+async def _save(key, entry):
+    row = await database.save_cached_definition(key, ai_client.PROMPT_VERSION, *definition_format.to_columns(entry))
+    result = (row['id'], definition_format.from_row(row))
+    _cache.set(key, result)
+    return result
+
+
+def _finish(key, future):
+    if _in_flight.get(key) is future:
+        del _in_flight[key]
+    # Mark the error as retrieved in case every waiter was cancelled
+    if not future.cancelled():
+        future.exception()
+
+
+async def _resolve(key: str, word: str, models=None):
+    result = await _from_db(key)
+    if result is not None:
+        return result
+
+    _counters["misses"] += 1
+    try:
+        entry = await ai_client.fetch_definition(word, models=models)
+    except ai_client.BudgetExhausted:
+        # Not the word's fault: let the caller decide when to try again
+        raise
+    except ai_client.DefinitionUnavailable:
+        return None, None
+
+    return await _save(key, entry)
+
+
+async def _resolve_streaming(key: str, word: str, on_progress):
+    result = await _from_db(key)
+    if result is not None:
+        return result
+
+    _counters["misses"] += 1
+    entry = None
+    last_progress = None
+    try:
+        async for entry in ai_client.stream_definition(word):
+            now = time.monotonic()
+            if entry.get("definition") and (last_progress is None or now - last_progress >= STREAM_EDIT_INTERVAL):
+                last_progress = now
+                await on_progress(definition_format.render(entry, markdown=False))
+    except ai_client.BudgetExhausted:
+        # Delivered to lookup waiters as is, so background jobs keep their attempt
+        raise
+    except ai_client.DefinitionUnavailable:
+        return None, None
+
+    return await _save(key, entry)
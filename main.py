@@ -1,13 +1,32 @@
+import asyncio
+import io
 import logging
 import os
-from datetime import datetime
+import re
+import tempfile
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram.error import TelegramError
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ConversationHandler
 
 import database
-import ai_client
+import definition_format
+import definition_jobs
+import definitions
+import metrics
+import persistence
+import rate_limit
+import reminders
+import review_session
+import scheduler_optimizer
+import shared_queue
 import spaced_repetition
+import users
+import webserver
+import word_export
+import word_import
+import word_search
 
 # Load environment variables
 load_dotenv()
@@ -18,9 +37,38 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# "polling" (default) or "webhook", see webserver.py
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "true").lower() == "true"
+# "all" (default), or "ingress"/"worker" for the multi-worker setup, see shared_queue.py
+BOT_ROLE = os.getenv("BOT_ROLE", "all").lower()
+# Keep user_data and dialogs in PostgreSQL (always on for workers)
+BOT_PERSISTENCE = os.getenv("BOT_PERSISTENCE", "false").lower() == "true"
+
+# Telegram user IDs allowed to run service commands (comma-separated)
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(',') if x.strip()}
+
+async def save_word(user_id, word, entry, definition_id=None):
+    """
+    Save a word with its definition_format entry and return its ID. The user's row
+    exists afterwards (add_word adds it) and their search index is stale.
+    """
+    definition, details = definition_format.to_columns(entry)
+    word_id = await database.add_word(
+        user_id, word, definition, datetime.now(), definition_id=definition_id, details=details
+    )
+    users.mark_known(user_id)
+    word_search.invalidate(user_id)
+    return word_id
+
+async def word_definition(user_id, word_id):
+    """A saved word's definition as Markdown message text"""
+    row = await database.get_word_definition(user_id, word_id)
+    return definition_format.render(definition_format.from_row(row)) if row else ""
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    database.add_user(user_id)
+    await users.ensure_user(user_id)
     await update.message.reply_text(
         "Welcome! Send me any word to get a definition and add it to your learning list.\n"
         "Use /train to start a spaced repetition session."
@@ -33,53 +81,50 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if word.startswith('/'):
         return
 
-    # Send "Defining..." message and save it to delete later
-    status_message = await update.message.reply_text(f"🔍 Defining '{word}'...")
-    
-    definition_text = ai_client.get_definition(word)
-    
-    # Ensure user exists in DB before adding word
-    database.add_user(user_id)
-    
-    # Save to DB
-    database.add_word(user_id, word, definition_text, datetime.now())
-    
-    # Use Markdown escape for safety or just standard text.
-    # We will use simple formatting.
-    response = f"📖 *{word}*\n\n{definition_text}\n\n_Word saved to library._"
-    
-    await update.message.reply_text(response, parse_mode='Markdown')
+    # Known words are answered right away
+    cached = await definitions.cached(word)
+    if cached is not None:
+        definition_id, entry = cached
+        await save_word(user_id, word, entry, definition_id)
+        await update.message.reply_text(definition_jobs.format_saved_word(word, entry), parse_mode='Markdown')
+        return
     
-    # Delete the "Defining..." message
-    await status_message.delete()
-
-async def train(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    due_words = database.get_due_words(user_id)
+    status_message = await update.message.reply_text(f"🔍 Defining '{word}'...")
     
-    if not due_words:
-        msg = "🎉 Все слова изучены! На сегодня это все. Приходите завтра! 🧠"
-        if update.callback_query:
-            await update.callback_query.message.edit_text(msg)
-        else:
-            await update.message.reply_text(msg)
-        return
+    if definitions.DEFINITION_STREAMING:
+        async def show_progress(text):
+            # Plain text while streaming: half-written Markdown would be rejected
+            try:
+                await status_message.edit_text(f"📖 {word}\n\n{text} ▌")
+            except TelegramError:
+                pass
+        
+        definition_id, entry = await definitions.lookup_streaming(word, show_progress)
+        if definition_id is not None:
+            await save_word(user_id, word, entry, definition_id)
+            await status_message.edit_text(definition_jobs.format_saved_word(word, entry), parse_mode='Markdown')
+            return
+    
+    # Otherwise save the word now and let a background worker fill in the definition
+    word_id = await save_word(user_id, word, definition_format.from_columns(definition_jobs.PENDING_DEFINITION))
+    await definition_jobs.enqueue(word_id, word, status_message.chat_id, status_message.message_id)
 
-    # Pick the first one
-    word_row = due_words[0]
-    word_id = word_row['id']
-    word = word_row['word']
+async def show_review_card(update: Update, card, due_count=None):
+    word_id = card['id']
+    level = card['level']
     
-    # Show ONLY the word first
+    # Show ONLY the word first; the level also travels with the buttons in case the session is gone
     keyboard = [
         [
-            InlineKeyboardButton("✅ I know it", callback_data=f"know_{word_id}"),
-            InlineKeyboardButton("❌ I forgot", callback_data=f"forgot_{word_id}")
+            InlineKeyboardButton("✅ I know it", callback_data=f"know_{word_id}_{level}"),
+            InlineKeyboardButton("❌ I forgot", callback_data=f"forgot_{word_id}_{level}")
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    text = f"📝 **Review**: {word}"
+    text = f"📝 **Review**: {card['word']}"
+    if due_count:
+        text += f"\n\n⏰ Осталось слов: {due_count}"
     
     if update.callback_query:
         # If we are coming from a "Next" button or previous card
@@ -87,100 +132,188 @@ async def train(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
 
+async def show_training_done(update: Update):
+    msg = "🎉 Все слова изучены! На сегодня это все. Приходите завтра! 🧠"
+    if update.callback_query:
+        await update.callback_query.message.edit_text(msg)
+    else:
+        await update.message.reply_text(msg)
+
+async def show_next_card(update: Update, session):
+    card = review_session.current_card(session)
+    if card is None:
+        # Batch exhausted: save answers and pick up words that became due meanwhile
+        await review_session.refill(session)
+        card = review_session.current_card(session)
+    
+    if card is None:
+        await show_training_done(update)
+        return
+    
+    await show_review_card(update, card)
+
+async def train(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    session = await review_session.start(context.user_data, user_id)
+    card = review_session.current_card(session)
+    
+    if card is None:
+        await show_training_done(update)
+        return
+
+    due_count = len(session['queue'])
+    if due_count >= review_session.REVIEW_BATCH_SIZE:
+        due_count = await database.count_due_words(user_id)
+    
+    await show_review_card(update, card, due_count)
+
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
+    user_id = update.effective_user.id
     data = query.data
     
+    session = review_session.get(context.user_data)
+    if session is None:
+        # Bot restarted since the card was shown
+        session = await review_session.start(context.user_data, user_id)
+    
     if data.startswith("next_"):
-        # Just trigger train() again
-        await train(update, context)
+        await show_next_card(update, session)
         return
 
-    action, word_id_str = data.split('_')
+    action, word_id_str, *level_str = data.split('_')
     word_id = int(word_id_str)
     
-    word_row = database.get_word(word_id)
-    if not word_row:
-        await query.message.edit_text("Error: Word not found.")
+    card = review_session.take_card(session, word_id)
+    if not card:
+        # Card from an older message that is no longer in the session
+        word_row = await database.get_word(word_id)
+        if not word_row or word_row['user_id'] != user_id:
+            await query.message.edit_text("Error: Word not found.")
+            return
+        card = review_session.card_from_row(word_row)
+        if level_str:
+            card['level'] = int(level_str[0])
+    
+    is_correct = action == "know"
+    scheduler = spaced_repetition.get_scheduler()
+    new_state = scheduler.review(card, is_correct, scale=session.get('stability_scale'))
+    await review_session.record_answer(session, card, new_state, is_correct, scheduler.name)
+    if review_session.needs_flush(session):
+        await review_session.flush(session)
+    
+    if is_correct:
+        # Move to the next word immediately
+        await show_next_card(update, session)
         return
+    
+    # Forgotten words come back at the end of the session
+    session['queue'].append(card)
+    
+    # Show definition and "Next" button
+    keyboard = [
+        [InlineKeyboardButton("➡️ Next", callback_data=f"next_{word_id}")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    # Cards do not carry definitions, only the forgotten ones are looked up
+    definition = await word_definition(user_id, word_id)
+    text = f"📝 **Review**: {card['word']}\n\n❌ **Forgot**\n\n{definition}"
+    
+    await query.message.edit_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+
+# Words per /list page
+LIST_PAGE_SIZE = 20
 
-    current_level = word_row['repetition_level']
+def encode_list_cursor(word_row):
+    """Compact (created_at, id) cursor for callback data"""
+    created_at = word_row['created_at']
+    micros = (created_at - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+    return f"{micros}_{word_row['id']}"
+
+def decode_list_cursor(micros_str, id_str):
+    return datetime(1970, 1, 1) + timedelta(microseconds=int(micros_str)), int(id_str)
+
+def review_status(next_review):
+    if not next_review:
+        return "🆕 Новое"
+    
+    now = datetime.now()
+    if next_review <= now:
+        return "⏰ Готово к повторению"
+    
+    days_left = (next_review - now).days
+    if days_left == 0:
+        return "📅 Сегодня"
+    elif days_left == 1:
+        return "📅 Завтра"
+    return f"📅 Через {days_left} дн."
+
+def render_words_page(words, has_newer, has_older):
+    message = "📚 *Ваши слова*:\n\n"
     
-    if action == "know":
-        # Mark correct, move to next immediately (or show brief success? User said "If forgot -> show definition". Implies know -> just go next)
-        new_level, next_review = spaced_repetition.calculate_next_review(current_level, is_correct=True)
-        database.update_word_progress(word_id, new_level, next_review)
-        
-        # Trigger next word
-        await train(update, context)
-        
-    elif action == "forgot":
-        # Mark incorrect
-        new_level, next_review = spaced_repetition.calculate_next_review(current_level, is_correct=False)
-        database.update_word_progress(word_id, new_level, next_review)
-        
-        # Show definition and "Next" button
-        definition = word_row['definition']
-        
-        keyboard = [
-            [InlineKeyboardButton("➡️ Next", callback_data=f"next_{word_id}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    for word_row in words:
+        level = word_row['repetition_level']
         
-        text = f"📝 **Review**: {word_row['word']}\n\n❌ **Forgot**\n\n{definition}"
+        # Add emoji based on level
+        level_emoji = "🌱" if level == 0 else "🌿" if level <= 2 else "🌳"
         
-        await query.message.edit_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+        message += f"{level_emoji} *{word_row['word']}* — {review_status(word_row['next_review_at'])}\n"
+    
+    message += f"\n💡 Используйте /train для начала повторения"
+    
+    # Cursors point at the first/last word shown, pages are fetched relative to them
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"list_p_{encode_list_cursor(words[0])}"))
+    if has_older:
+        buttons.append(InlineKeyboardButton("Далее ➡️", callback_data=f"list_n_{encode_list_cursor(words[-1])}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    
+    return message, reply_markup
 
 async def list_words(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    words = database.get_all_user_words(user_id)
+    words, has_older = await database.get_words_page(user_id, LIST_PAGE_SIZE)
     
     if not words:
         await update.message.reply_text("📚 Ваш список слов пуст. Отправьте любое слово, чтобы добавить его!")
         return
     
-    # Format the list
-    message = f"📚 *Ваши слова* ({len(words)} всего):\n\n"
+    message, reply_markup = render_words_page(words, has_newer=False, has_older=has_older)
+    await update.message.reply_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+
+async def list_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-    for word_row in words:
-        word = word_row['word']
-        level = word_row['repetition_level']
-        next_review = word_row['next_review_at']
-        
-        # Parse next review date
-        if next_review:
-            try:
-                review_date = datetime.fromisoformat(next_review)
-                now = datetime.now()
-                if review_date <= now:
-                    status = "⏰ Готово к повторению"
-                else:
-                    days_left = (review_date - now).days
-                    if days_left == 0:
-                        status = "📅 Сегодня"
-                    elif days_left == 1:
-                        status = "📅 Завтра"
-                    else:
-                        status = f"📅 Через {days_left} дн."
-            except:
-                status = "📅 Скоро"
-        else:
-            status = "🆕 Новое"
-        
-        # Add emoji based on level
-        level_emoji = "🌱" if level == 0 else "🌿" if level <= 2 else "🌳"
-        
-        message += f"{level_emoji} *{word}* — {status}\n"
+    user_id = update.effective_user.id
+    _, direction, micros_str, id_str = query.data.split('_')
+    cursor = decode_list_cursor(micros_str, id_str)
     
-    message += f"\n💡 Используйте /train для начала повторения"
+    if direction == "n":
+        words, has_older = await database.get_words_page(user_id, LIST_PAGE_SIZE, older_than=cursor)
+        has_newer = True
+    else:
+        words, has_newer = await database.get_words_page(user_id, LIST_PAGE_SIZE, newer_than=cursor)
+        has_older = True
     
-    await update.message.reply_text(message, parse_mode='Markdown')
+    if not words:
+        # The words around the cursor were deleted, start over
+        words, has_older = await database.get_words_page(user_id, LIST_PAGE_SIZE)
+        has_newer = False
+        if not words:
+            await query.message.edit_text("📚 Ваш список слов пуст. Отправьте любое слово, чтобы добавить его!")
+            return
+    
+    message, reply_markup = render_words_page(words, has_newer, has_older)
+    await query.message.edit_text(message, parse_mode='Markdown', reply_markup=reply_markup)
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    stats = database.get_user_stats(user_id)
+    stats = await database.get_user_stats(user_id)
     
     if stats['total'] == 0:
         await update.message.reply_text(
@@ -204,24 +337,45 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
+async def reminders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    choice = context.args[0].lower() if context.args else None
+    
+    if choice in ('on', 'off'):
+        settings = await users.update_settings(user_id, reminders=choice == 'on')
+    else:
+        settings = await users.get_settings(user_id)
+    
+    status = "включены" if settings['reminders'] else "выключены"
+    await update.message.reply_text(
+        f"🔔 Напоминания о словах к повторению {status}.\n\n"
+        "Включить: /reminders on\n"
+        "Выключить: /reminders off"
+    )
+
 async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     if not context.args:
         await update.message.reply_text(
             "🔍 Использование: /search слово\n\n"
-            "Пример: /search apple"
+            "Пример: /search apple\n"
+            "Опечатки не страшны: /search recieve найдет receive.\n"
+            "Искать и в определениях: /search -d fruit"
         )
         return
     
-    search_term = ' '.join(context.args)
-    
-    # Try exact match first
-    results = database.search_word_exact(user_id, search_term)
+    args = context.args
+    in_definitions = args[0] == "-d"
+    if in_definitions:
+        args = args[1:]
+    search_term = ' '.join(args)
+    if not search_term:
+        await update.message.reply_text("🔍 Использование: /search -d слово")
+        return
     
-    # If no exact match, try partial
-    if not results:
-        results = database.search_word_partial(user_id, search_term)
+    # Exact word first, then prefixes, substrings and similar words
+    results = await word_search.search(user_id, search_term, in_definitions)
     
     if not results:
         await update.message.reply_text(
@@ -231,11 +385,16 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
+    # An exact hit shows its definition right away
+    if not in_definitions and definitions.normalize_word(results[0]['word']) == definitions.normalize_word(search_term):
+        results = results[:1]
+    
     if len(results) == 1:
         word_row = results[0]
         level_emoji = "🌱" if word_row['repetition_level'] == 0 else "🌿" if word_row['repetition_level'] <= 2 else "🌳"
         
-        message = f"{level_emoji} *{word_row['word']}*\n\n{word_row['definition']}\n\n_Уровень: {word_row['repetition_level']}_"
+        definition = await word_definition(user_id, word_row['id'])
+        message = f"{level_emoji} {definition_format.bold(word_row['word'])}\n\n{definition}\n\n_Уровень: {word_row['repetition_level']}_"
         await update.message.reply_text(message, parse_mode='Markdown')
     else:
         message = f"🔍 Найдено слов: {len(results)}\n\n"
@@ -247,18 +406,88 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(message, parse_mode='Markdown')
 
 
+async def export_words(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    fmt = context.args[0].lower() if context.args else "csv"
+    
+    if fmt not in word_export.FORMATS:
+        await update.message.reply_text(
+            "Использование: /export [csv|json|anki]\n"
+            "anki — файл для импорта в Anki (Файл → Импорт)"
+        )
+        return
+    
+    # Written to disk chunk by chunk, so a large vocabulary never sits in memory
+    with tempfile.TemporaryFile() as raw:
+        out = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        count = await word_export.write_words(user_id, fmt, out)
+        out.flush()
+        out.detach()
+        
+        if count == 0:
+            await update.message.reply_text("📭 Ваш список пуст. Нечего экспортировать.")
+            return
+        
+        raw.seek(0)
+        await update.message.reply_document(
+            document=raw,
+            filename=f"words.{word_export.FILE_EXTENSIONS[fmt]}",
+            caption=f"📦 Экспортировано слов: {count}",
+        )
+
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    
+    counters = definitions.cache_stats()
+    lookups = counters['memory_hits'] + counters['db_hits'] + counters['misses']
+    hit_rate = (counters['memory_hits'] + counters['db_hits']) / lookups * 100 if lookups else 0
+    jobs = await definition_jobs.queue_stats()
+    
+    await update.message.reply_text(
+        "🗄 Definition cache\n\n"
+        f"Memory hits: {counters['memory_hits']}\n"
+        f"DB hits: {counters['db_hits']}\n"
+        f"Misses: {counters['misses']}\n"
+        f"Coalesced: {counters['coalesced']}\n"
+        f"Hit rate: {hit_rate:.1f}%\n"
+        f"Entries in memory: {counters['memory_size']}\n\n"
+        "⏳ Definition jobs\n\n"
+        f"Queued: {jobs['depth']}\n"
+        f"Due: {jobs['due']}\n"
+        f"Oldest: {jobs['oldest_age']:.0f}s"
+    )
+
+
 # Delete command conversation states
 WAITING_FOR_DELETE_INPUT = 1
 
+# Numbers and ranges from the /delete list, e.g. "1-50, 60"
+DELETE_NUMBERS_PATTERN = re.compile(r'\s*\d+(\s*-\s*\d+)?(\s*,\s*\d+(\s*-\s*\d+)?)*\s*,?\s*')
+
+def parse_delete_numbers(text, count):
+    """1-based positions chosen in the /delete list, or None if the text is not numbers and ranges"""
+    if not DELETE_NUMBERS_PATTERN.fullmatch(text):
+        return None
+    positions = []
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        first, _, last = part.partition('-')
+        first, last = sorted((int(first), int(last) if last.strip() else int(first)))
+        positions.extend(range(max(first, 1), min(last, count) + 1))
+    return list(dict.fromkeys(positions))
+
 async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check if word is provided as argument
     if context.args:
         word_to_delete = ' '.join(context.args)
-        deleted = database.delete_word_by_text(user_id, word_to_delete)
+        deleted = await database.delete_words_by_text(user_id, [word_to_delete])
         
         if deleted:
+            word_search.invalidate(user_id)
             await update.message.reply_text(f"✅ Слово *{word_to_delete}* удалено из списка.", parse_mode='Markdown')
         else:
             await update.message.reply_text(f"❌ Слово *{word_to_delete}* не найдено в вашем списке.", parse_mode='Markdown')
@@ -266,21 +495,21 @@ async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     
     # No arguments - show interactive list
-    words = database.get_all_user_words(user_id)
+    words = await database.get_all_user_words(user_id)
     
     if not words:
         await update.message.reply_text("📚 Ваш список слов пуст.")
         return ConversationHandler.END
     
-    # Store words in context for later use
-    context.user_data['delete_words'] = words
+    # Only the ids are kept: the numbers in the reply refer to this order
+    context.user_data['delete_word_ids'] = [word_row['id'] for word_row in words]
     
     # Format numbered list
     message = "📝 *Выберите слова для удаления:*\n\n"
     for idx, word_row in enumerate(words, 1):
         message += f"{idx}. {word_row['word']}\n"
     
-    message += "\n💡 Введите номера через запятую (например: 1,3,5) или названия слов.\n"
+    message += "\n💡 Введите номера через запятую или диапазоны (например: 1,3,5 или 1-50) или названия слов.\n"
     message += "Для отмены введите /cancel"
     
     await update.message.reply_text(message, parse_mode='Markdown')
@@ -290,38 +519,29 @@ async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def delete_process_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_input = update.message.text.strip()
-    words = context.user_data.get('delete_words', [])
+    word_ids = context.user_data.get('delete_word_ids', [])
     
-    if not words:
+    if not word_ids:
         await update.message.reply_text("❌ Ошибка: список слов не найден. Попробуйте /delete снова.")
         return ConversationHandler.END
     
-    deleted_words = []
-    
-    # Check if input contains numbers (comma-separated)
-    if ',' in user_input or user_input.isdigit():
-        # Parse as numbers
-        try:
-            indices = [int(x.strip()) for x in user_input.split(',')]
-            for idx in indices:
-                if 1 <= idx <= len(words):
-                    word_row = words[idx - 1]
-                    if database.delete_word_by_id(word_row['id']):
-                        deleted_words.append(word_row['word'])
-        except ValueError:
-            await update.message.reply_text("❌ Неверный формат. Используйте номера через запятую (например: 1,3,5)")
-            return WAITING_FOR_DELETE_INPUT
+    positions = parse_delete_numbers(user_input, len(word_ids))
+    if positions is not None:
+        # One statement for the whole selection; ids of other users are never deleted
+        deleted_words = await database.delete_words_by_ids(user_id, [word_ids[idx - 1] for idx in positions])
+    elif any(char.isdigit() for char in user_input) and not any(char.isalpha() for char in user_input):
+        await update.message.reply_text("❌ Неверный формат. Используйте номера через запятую или диапазоны (например: 1,3,5 или 1-50)")
+        return WAITING_FOR_DELETE_INPUT
     else:
         # Parse as word names (comma-separated or single word)
-        word_names = [w.strip() for w in user_input.split(',')]
-        for word_name in word_names:
-            if database.delete_word_by_text(user_id, word_name):
-                deleted_words.append(word_name)
+        word_names = [w.strip() for w in user_input.split(',') if w.strip()]
+        deleted_words = await database.delete_words_by_text(user_id, word_names)
     
     # Clear context
-    context.user_data.pop('delete_words', None)
+    context.user_data.pop('delete_word_ids', None)
     
     if deleted_words:
+        word_search.invalidate(user_id)
         words_list = ", ".join([f"*{w}*" for w in deleted_words])
         await update.message.reply_text(f"✅ Удалено слов: {len(deleted_words)}\n\n{words_list}", parse_mode='Markdown')
     else:
@@ -330,13 +550,110 @@ async def delete_process_input(update: Update, context: ContextTypes.DEFAULT_TYP
     return ConversationHandler.END
 
 async def delete_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.pop('delete_words', None)
+    context.user_data.pop('delete_word_ids', None)
     await update.message.reply_text("❌ Удаление отменено.")
     return ConversationHandler.END
 
 
+# Import command conversation states
+WAITING_FOR_IMPORT = 2
+
+IMPORT_DOCUMENT_FILTER = filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv")
+
+async def run_import(update: Update, text):
+    user_id = update.effective_user.id
+    words = word_import.parse_words(text)
+    
+    if not words:
+        await update.message.reply_text("❌ Не нашел ни одного слова. Пришлите слова по одному на строку.")
+        return
+    if len(words) > word_import.IMPORT_MAX_WORDS:
+        await update.message.reply_text(
+            f"❌ Слишком много слов: {len(words)}. За один раз можно импортировать не больше {word_import.IMPORT_MAX_WORDS}."
+        )
+        return
+    
+    header = f"📥 Импортирую слов: {len(words)}..."
+    status_message = await update.message.reply_text(header)
+    
+    async def progress(done, total):
+        try:
+            await status_message.edit_text(f"{header}\nПолучено определений: {done} из {total}")
+        except TelegramError:
+            pass
+    
+    counts = await word_import.import_words(user_id, words, progress)
+    
+    lines = [f"✅ Добавлено слов: {counts['added']}"]
+    if counts['existing']:
+        lines.append(f"Уже были в списке: {counts['existing']}")
+    if counts['pending']:
+        lines.append(f"⏳ Определения для {counts['pending']} слов появятся чуть позже.")
+    await status_message.edit_text("\n".join(lines))
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Words may follow the command on the next lines, keep them as they are
+    parts = update.message.text.split(None, 1)
+    if len(parts) > 1:
+        await run_import(update, parts[1])
+        return ConversationHandler.END
+    
+    await update.message.reply_text(
+        "📥 Пришлите список слов по одному на строку или файл .txt/.csv.\n"
+        "Для отмены используйте /cancel"
+    )
+    return WAITING_FOR_IMPORT
+
+async def import_process_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await run_import(update, update.message.text)
+    return ConversationHandler.END
+
+async def import_process_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    if document.file_size and document.file_size > word_import.IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text(
+            f"❌ Файл слишком большой. Максимум {word_import.IMPORT_MAX_FILE_SIZE // 1024} КБ."
+        )
+        return ConversationHandler.END
+    
+    file = await document.get_file()
+    data = await file.download_as_bytearray()
+    await run_import(update, bytes(data).decode('utf-8-sig', errors='replace'))
+    return ConversationHandler.END
+
+async def import_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("❌ Импорт отменен.")
+    return ConversationHandler.END
+
+
 async def post_init(application):
-    """Set up bot commands menu"""
+    """Open the database pool, start background jobs and set up bot commands menu"""
+    await database.init_db()
+    await review_session.ensure_log_partitions()
+    await scheduler_optimizer.load_global_params()
+    
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            review_session.flush_job,
+            interval=review_session.REVIEW_FLUSH_INTERVAL,
+            first=review_session.REVIEW_FLUSH_INTERVAL,
+        )
+        application.job_queue.run_repeating(
+            review_session.ensure_log_partitions,
+            interval=timedelta(days=1),
+            first=timedelta(days=1),
+        )
+        if BOT_ROLE != "ingress" and reminders.REMINDER_CHECK_INTERVAL > 0:
+            application.job_queue.run_repeating(
+                reminders.tick,
+                interval=reminders.REMINDER_CHECK_INTERVAL,
+                first=reminders.REMINDER_CHECK_INTERVAL,
+            )
+    else:
+        logging.warning("JobQueue is not available, review answers are only saved by sessions themselves")
+    if BOT_ROLE != "ingress":
+        definition_jobs.start(application.bot)
+    await metrics.start(application)
     await application.bot.set_my_commands([
         BotCommand("start", "Начать работу с ботом"),
         BotCommand("train", "Начать сессию повторения слов"),
@@ -344,27 +661,37 @@ async def post_init(application):
         BotCommand("stats", "Показать статистику обучения"),
         BotCommand("search", "Найти слово в словаре"),
         BotCommand("delete", "Удалить слова из списка"),
+        BotCommand("import", "Добавить много слов сразу"),
+        BotCommand("export", "Выгрузить слова в CSV, JSON или Anki"),
+        BotCommand("reminders", "Включить или выключить напоминания"),
     ])
 
 
-if __name__ == '__main__':
-    # Initialize DB
-    database.init_db()
-    
-    # Build App
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not token or token == "YOUR_BOT_TOKEN_HERE":
-        print("Error: TELEGRAM_BOT_TOKEN not set in .env")
-        exit(1)
-        
-    application = ApplicationBuilder().token(token).post_init(post_init).build()
-    
+async def post_stop(application):
+    """Stop metrics, reminders and background lookups while the bot can still send their last messages"""
+    await metrics.stop()
+    await reminders.stop()
+    await definition_jobs.stop()
+
+
+async def post_shutdown(application):
+    """Save buffered review answers and close pooled database connections"""
+    await review_session.flush_all(application)
+    await database.close_pool()
+
+
+def add_handlers(application):
+    """Register all bot handlers on an application"""
     start_handler = CommandHandler('start', start)
     message_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message)
     train_handler = CommandHandler('train', train)
     list_handler = CommandHandler('list', list_words)
     stats_handler = CommandHandler('stats', stats)
     search_handler = CommandHandler('search', search)
+    reminders_handler = CommandHandler('reminders', reminders_command)
+    export_handler = CommandHandler('export', export_words)
+    cache_stats_handler = CommandHandler('cachestats', cache_stats)
+    list_page_handler = CallbackQueryHandler(list_page, pattern=r'^list_')
     callback_handler = CallbackQueryHandler(button)
     
     # Delete conversation handler
@@ -374,19 +701,82 @@ if __name__ == '__main__':
             WAITING_FOR_DELETE_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_process_input)],
         },
         fallbacks=[CommandHandler('cancel', delete_cancel)],
+        name='delete',
+        persistent=application.persistence is not None,
     )
     
+    # Import conversation handler
+    import_conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler('import', import_command),
+            MessageHandler(IMPORT_DOCUMENT_FILTER, import_process_document),
+        ],
+        states={
+            WAITING_FOR_IMPORT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, import_process_text),
+                MessageHandler(IMPORT_DOCUMENT_FILTER, import_process_document),
+            ],
+        },
+        fallbacks=[CommandHandler('cancel', import_cancel)],
+        name='import',
+        persistent=application.persistence is not None,
+    )
+    
+    # Before everything else: a flooding user does not reach the handlers below
+    rate_limit.add_handler(application)
     application.add_handler(start_handler)
     application.add_handler(train_handler)
     application.add_handler(list_handler)
     application.add_handler(stats_handler)
     application.add_handler(search_handler)
+    application.add_handler(reminders_handler)
+    application.add_handler(export_handler)
+    application.add_handler(cache_stats_handler)
     application.add_handler(delete_conv_handler)
+    application.add_handler(import_conv_handler)
+    application.add_handler(list_page_handler)
     application.add_handler(callback_handler)
     application.add_handler(message_handler) 
-    
-    print("Bot is running...")
-    # Drop pending updates to avoid conflicts when restarting
-    application.run_polling(drop_pending_updates=True)
 
 
+if __name__ == '__main__':
+    # Build App
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token or token == "YOUR_BOT_TOKEN_HERE":
+        print("Error: TELEGRAM_BOT_TOKEN not set in .env")
+        exit(1)
+        
+    # Handle updates concurrently so one slow request does not block other users
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        # Same pool size as the builder's default request, plus per-method latency metrics
+        .request(metrics.InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_ROLE == "worker":
+        # Updates come from the shared queue, not from Telegram
+        builder = builder.updater(None).persistence(
+            persistence.PostgresPersistence(shared_queue.owned_partitions())
+        )
+    elif BOT_PERSISTENCE and BOT_ROLE != "ingress":
+        builder = builder.persistence(persistence.PostgresPersistence())
+    application = builder.build()
+    
+    if BOT_ROLE == "ingress":
+        shared_queue.add_ingress_handler(application)
+    else:
+        add_handlers(application)
+    metrics.instrument_handlers(application)
+    
+    if BOT_ROLE == "worker":
+        asyncio.run(shared_queue.run_worker(application))
+    elif BOT_MODE == "webhook":
+        asyncio.run(webserver.run_webhook(application))
+    else:
+        print("Bot is running...")
+        # Drop pending updates to avoid conflicts when restarting (set DROP_PENDING_UPDATES=false to keep them)
+        application.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
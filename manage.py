@@ -0,0 +1,301 @@
+"""
+Maintenance commands.
+
+    python3 manage.py migrate         apply pending schema migrations
+    python3 manage.py check-indexes   EXPLAIN every query in database.py and
+                                      fail if one of them scans a whole table
+    python3 manage.py rebuild-stats   recount /stats counters from scratch
+                                      (--user ID for a single user)
+    python3 manage.py dump            write every user's words as CSV to stdout
+                                      (--user ID, --output FILE)
+    python3 manage.py reschedule      recompute due dates with the current
+                                      scheduler settings (--user ID)
+    python3 manage.py optimize-scheduler
+                                      fit interval scales from the review log
+                                      (--per-user, --since DAYS)
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import sys
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import database
+import scheduler_optimizer
+import spaced_repetition
+
+# Tables that grow with the number of users and must never be scanned in full
+LARGE_TABLES = {"users", "words", "definitions", "update_queue", "bot_state", "definition_jobs",
+                "review_log", "rate_limits"}
+
+# database.py functions and sample arguments used to capture their queries
+CHECKED_QUERIES = [
+    ("add_user", (1,)),
+    ("get_user_settings", (1,)),
+    ("update_user_settings", (1, "{}")),
+    ("claim_reminders", (datetime.now(), datetime.now(), 1, 500, 100)),
+    ("add_word", (1, "word", "definition", datetime.now(), None)),
+    ("add_words", (1, [("word", "definition", None, None)], datetime.now())),
+    ("get_existing_words", (1, ["word"])),
+    ("get_cached_definition", ("word", "version")),
+    ("get_cached_definitions", (["word"], "version")),
+    ("save_cached_definition", ("word", "version", "definition")),
+    ("get_word_definition", (1, 1)),
+    ("get_due_batch", (1, 50)),
+    ("count_due_words", (1,)),
+    ("buffer_review_answer", (1, {
+        "id": 1, "level": 1, "ease": 2.5, "stability": 1.0, "difficulty": None, "lapses": 0,
+        "last_review_at": datetime.now(), "next_review_at": datetime.now(),
+        "grade": 3, "scheduler": "ladder", "elapsed_days": 1.0, "prior_interval": 1.0, "stability_before": 1.0,
+    })),
+    ("flush_review_answers", (1,)),
+    ("get_buffered_review_users", ()),
+    ("get_word", (1,)),
+    ("get_all_user_words", (1,)),
+    ("iter_user_words", (1,)),
+    ("get_words_page", (1, 20)),
+    ("get_words_page", (1, 20, (datetime.now(), 1))),
+    ("get_words_page", (1, 20, None, (datetime.now(), 1))),
+    ("delete_words_by_ids", (1, [1, 2])),
+    ("delete_words_by_text", (1, ["word"])),
+    # search_words_fuzzy is left out: it needs pg_trgm, which is optional
+    ("search_definitions", (1, "wor", 10)),
+    ("get_search_entries", (1,)),
+    ("get_words_by_ids", (1, [1, 2])),
+    ("get_user_stats", (1,)),
+    ("rebuild_user_stats", (1,)),
+    ("enqueue_update", (0, 1, "{}")),
+    ("fetch_queued_updates", (0, 100)),
+    ("fetch_queued_updates", (0, 100, [1, 2])),
+    ("delete_queued_updates", ([1],)),
+    ("get_update_queue_stats", (datetime.now(),)),
+    ("load_bot_state", ("user_data", [0])),
+    ("save_bot_state", ("user_data", "1", 0, b"")),
+    ("delete_bot_state", ("user_data", "1")),
+    ("enqueue_definition_job", (1, "word", 1, 1, datetime.now())),
+    ("save_scheduler_params", ("fsrs", 0, "{}", 0, 0.0, 0.0)),
+    ("get_scheduler_params", ("fsrs", 1)),
+    ("enqueue_definition_jobs", ([1], ["word"], datetime.now())),
+    ("claim_definition_job", (datetime.now(), datetime.now())),
+    ("complete_definition_job", (1, 1, "definition", 1)),
+    ("complete_definition_job", (1, 1, "definition", None, None, "pending")),
+    ("retry_definition_job", (1, datetime.now(), "error")),
+    ("get_definition_job_stats", (datetime.now(),)),
+    ("take_rate_limit_tokens", ("user:1", 20.0, 0.5, 1.0, datetime.now())),
+]
+
+
+class _EmptyCursor:
+    async def fetch(self, n, **kwargs):
+        return []
+
+
+class _RecordingConnection:
+    """Stands in for a pooled connection and only remembers the queries it gets"""
+
+    def __init__(self):
+        self.queries = []
+
+    async def execute(self, query, *args, **kwargs):
+        self.queries.append((query, args))
+        return "SELECT 0"
+
+    async def executemany(self, query, args, **kwargs):
+        for row_args in args:
+            self.queries.append((query, tuple(row_args)))
+            break
+
+    async def fetch(self, query, *args, **kwargs):
+        self.queries.append((query, args))
+        return []
+
+    async def fetchrow(self, query, *args, **kwargs):
+        self.queries.append((query, args))
+        return None
+
+    async def fetchval(self, query, *args, **kwargs):
+        self.queries.append((query, args))
+        return None
+
+    async def cursor(self, query, *args, **kwargs):
+        self.queries.append((query, args))
+        return _EmptyCursor()
+
+    def transaction(self):
+        @asynccontextmanager
+        async def noop():
+            yield
+        return noop()
+
+
+async def _capture_queries(name, args):
+    recorder = _RecordingConnection()
+
+    @asynccontextmanager
+    async def recording_connection():
+        yield recorder
+
+    real_get_connection = database.get_connection
+    database.get_connection = recording_connection
+    try:
+        result = getattr(database, name)(*args)
+        if inspect.isasyncgen(result):
+            async for _ in result:
+                pass
+        else:
+            await result
+    finally:
+        database.get_connection = real_get_connection
+    return recorder.queries
+
+
+def _seq_scans(plan):
+    """Yield tables read with a sequential scan anywhere in a JSON plan"""
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from _seq_scans(child)
+
+
+async def check_indexes():
+    await database.init_db()
+    failures = 0
+    try:
+        async with database.get_connection() as conn:
+            for name, args in CHECKED_QUERIES:
+                for query, query_args in await _capture_queries(name, args):
+                    tr = conn.transaction()
+                    await tr.start()
+                    try:
+                        # Make the planner prefer any usable index, even on tiny tables
+                        await conn.execute('SET LOCAL enable_seqscan = off')
+                        result = await conn.fetchval('EXPLAIN (FORMAT JSON) ' + query, *query_args)
+                    finally:
+                        await tr.rollback()
+
+                    plan = json.loads(result)[0]["Plan"]
+                    scanned = sorted(set(_seq_scans(plan)) & LARGE_TABLES)
+                    if scanned:
+                        failures += 1
+                        print(f"FAIL {name}: full scan of {', '.join(scanned)}")
+                    else:
+                        print(f"ok   {name}")
+    finally:
+        await database.close_pool()
+    return failures
+
+
+async def migrate():
+    await database.create_pool()
+    try:
+        async with database.get_connection() as conn:
+            applied = await database.migrations.migrate(conn)
+    finally:
+        await database.close_pool()
+    if not applied:
+        print("Schema is up to date")
+
+
+async def rebuild_stats(user_id):
+    await database.init_db()
+    try:
+        fixed = await database.rebuild_user_stats(user_id)
+    finally:
+        await database.close_pool()
+    if fixed:
+        print(f"Fixed counters of {len(fixed)} user(s): {', '.join(map(str, fixed[:20]))}")
+    else:
+        print("All counters are consistent")
+
+
+async def dump(user_id, output):
+    await database.create_pool()
+    try:
+        count = await database.copy_words_to(output or sys.stdout.buffer, user_id)
+    finally:
+        await database.close_pool()
+    print(f"Dumped {count} word(s)", file=sys.stderr)
+
+
+async def reschedule(user_id, scheduler_name):
+    scheduler = spaced_repetition.get_scheduler(scheduler_name)
+    await database.init_db()
+    started = time.perf_counter()
+    try:
+        await scheduler_optimizer.load_global_params(scheduler.name)
+        changed = await database.reschedule_words(
+            lambda rows: spaced_repetition.reschedule_rows(scheduler, rows), scheduler.name, user_id
+        )
+    finally:
+        await database.close_pool()
+    print(f"Rescheduled {changed} word(s) with {scheduler.name} in {time.perf_counter() - started:.1f}s")
+
+
+async def optimize_scheduler(scheduler_name, since_days, per_user):
+    await database.init_db()
+    started = time.perf_counter()
+    try:
+        global_result, user_results = await scheduler_optimizer.optimize(scheduler_name, since_days, per_user)
+    finally:
+        await database.close_pool()
+    if global_result is None:
+        print(f"Not enough logged reviews to fit (need {scheduler_optimizer.OPTIMIZER_MIN_REVIEWS})")
+    else:
+        print(
+            f"Global stability scale {global_result['stability_scale']:.3f} from {global_result['reviews']} "
+            f"review(s): log-loss {global_result['log_loss']:.4f} (was {global_result['baseline_log_loss']:.4f})"
+        )
+    if per_user:
+        print(f"Fitted {len(user_results)} user(s)")
+    print(f"Done in {time.perf_counter() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Word Meaning Bot maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="apply pending schema migrations")
+    subparsers.add_parser("check-indexes", help="verify that every query in database.py uses an index")
+    rebuild_parser = subparsers.add_parser("rebuild-stats", help="recount per-user stats counters")
+    rebuild_parser.add_argument("--user", type=int, help="only this Telegram user ID")
+    dump_parser = subparsers.add_parser("dump", help="export words as CSV with COPY")
+    dump_parser.add_argument("--user", type=int, help="only this Telegram user ID")
+    dump_parser.add_argument("--output", help="file to write instead of stdout")
+    reschedule_parser = subparsers.add_parser("reschedule", help="recompute due dates of reviewed words")
+    reschedule_parser.add_argument("--user", type=int, help="only this Telegram user ID")
+    reschedule_parser.add_argument(
+        "--scheduler", choices=sorted(spaced_repetition.SCHEDULERS),
+        help="scheduler to use (default: SCHEDULER from the environment)",
+    )
+    optimize_parser = subparsers.add_parser("optimize-scheduler", help="fit interval scales from the review log")
+    optimize_parser.add_argument(
+        "--scheduler", choices=sorted(spaced_repetition.SCHEDULERS),
+        help="scheduler to fit (default: SCHEDULER from the environment)",
+    )
+    optimize_parser.add_argument("--per-user", action="store_true", help="also fit users with enough reviews")
+    optimize_parser.add_argument("--since", type=int, metavar="DAYS", help="only reviews of the last DAYS days")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        asyncio.run(migrate())
+    elif args.command == "check-indexes":
+        failures = asyncio.run(check_indexes())
+        raise SystemExit(1 if failures else 0)
+    elif args.command == "rebuild-stats":
+        asyncio.run(rebuild_stats(args.user))
+    elif args.command == "dump":
+        asyncio.run(dump(args.user, args.output))
+    elif args.command == "reschedule":
+        asyncio.run(reschedule(args.user, args.scheduler))
+    elif args.command == "optimize-scheduler":
+        asyncio.run(optimize_scheduler(args.scheduler, args.since, args.per_user))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+"""
+Prometheus metrics and runtime profiling.
+
+    bot_handler_seconds{handler}                 handler latency
+    bot_handler_component_seconds{handler,component}
+                                                 time a handler spent in db, llm and telegram calls
+    bot_db_query_seconds{function}               every query function in database.py
+    bot_db_rows_total{function}                  rows returned
+    bot_llm_request_seconds{model,outcome}       one model request (ok, timeout, empty, invalid, error)
+    bot_llm_tokens_total{model,kind}             prompt and completion tokens
+    bot_llm_fallbacks_total{model}               requests that moved on from a failed model
+    bot_llm_slot_wait_seconds{priority}          waits for one of LLM_MAX_CONCURRENCY request slots
+    bot_llm_budget_rejected_total                lookups refused by LLM_BUDGET_PER_MINUTE
+    bot_rate_limited_total{kind}                 updates dropped by the per-user rate limit
+    bot_reminders_total{outcome}                 review reminders sent, blocked by the user or failed
+    bot_telegram_request_seconds{method}         Bot API calls
+    bot_event_loop_lag_seconds                   how late the loop runs scheduled callbacks
+    bot_definition_jobs, bot_update_queue_*      queue depths, sampled every METRICS_SAMPLE_INTERVAL
+
+Served with a few debug endpoints on METRICS_HOST:METRICS_PORT:
+
+    GET  /metrics                       Prometheus text format
+    GET  /debug/profile                 cProfile stats of the sampled handler calls so far
+    POST /debug/profile?rate=0.05       profile 5% of handler calls from now on (0 stops)
+    POST /debug/profile?reset=1         forget the collected stats
+
+A handler slower than METRICS_SLOW_HANDLER seconds is logged with the time
+it spent in Postgres, OpenRouter and Telegram, so a slow reply can be
+traced to its cause. cProfile sees the whole thread, so a profiled call
+also records whatever other updates ran meanwhile.
+"""
+import asyncio
+import contextvars
+import cProfile
+import functools
+import inspect
+import io
+import logging
+import os
+import pstats
+import random
+import time
+from datetime import datetime
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from telegram.ext import ApplicationHandlerStop, ConversationHandler
+from telegram.request import HTTPXRequest
+
+# Local endpoint for /metrics; 0 disables it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# Seconds between samples of queue depths and event loop lag
+METRICS_SAMPLE_INTERVAL = float(os.getenv("METRICS_SAMPLE_INTERVAL", "15"))
+# Handlers slower than this many seconds are logged with their breakdown
+METRICS_SLOW_HANDLER = float(os.getenv("METRICS_SLOW_HANDLER", "2"))
+# Share of handler calls run under cProfile; can be changed at runtime
+PROFILE_SAMPLE_RATE = float(os.getenv("METRICS_PROFILE_RATE", "0"))
+
+LOOP_LAG_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handlers that raised", ["handler"])
+HANDLER_COMPONENT_SECONDS = Histogram(
+    "bot_handler_component_seconds", "Time a handler spent waiting on a component", ["handler", "component"]
+)
+DB_QUERY_SECONDS = Histogram(
+    "bot_db_query_seconds", "Query function latency", ["function"],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+DB_ROWS = Counter("bot_db_rows_total", "Rows returned by query functions", ["function"])
+DB_ERRORS = Counter("bot_db_errors_total", "Query functions that raised", ["function"])
+LLM_SECONDS = Histogram(
+    "bot_llm_request_seconds", "Model request latency", ["model", "outcome"],
+    buckets=(.25, .5, 1, 2, 3, 5, 8, 13, 20, 30, 60),
+)
+LLM_TOKENS = Counter("bot_llm_tokens_total", "Tokens used", ["model", "kind"])
+LLM_FALLBACKS = Counter("bot_llm_fallbacks_total", "Lookups that moved on from a failed model", ["model"])
+LLM_SLOT_WAIT_SECONDS = Histogram(
+    "bot_llm_slot_wait_seconds", "Wait for a free model request slot", ["priority"],
+    buckets=(.001, .01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+LLM_BUDGET_REJECTED = Counter("bot_llm_budget_rejected_total", "Lookups refused by the global budget")
+RATE_LIMITED = Counter("bot_rate_limited_total", "Updates dropped by the per-user rate limit", ["kind"])
+REMINDERS = Counter("bot_reminders_total", "Review reminders", ["outcome"])
+TELEGRAM_SECONDS = Histogram("bot_telegram_request_seconds", "Bot API call latency", ["method"])
+LOOP_LAG = Gauge("bot_event_loop_lag_seconds", "Latest event loop lag")
+LOOP_LAG_SECONDS = Histogram(
+    "bot_event_loop_lag_seconds_distribution", "Event loop lag",
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5),
+)
+DEFINITION_JOBS = Gauge("bot_definition_jobs", "Definition jobs in the queue", ["state"])
+DEFINITION_JOB_AGE = Gauge("bot_definition_job_oldest_seconds", "Age of the oldest definition job")
+UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue_depth", "Updates waiting in the shared queue (upper bound)")
+UPDATE_QUEUE_AGE = Gauge("bot_update_queue_oldest_seconds", "Age of the oldest update in the shared queue")
+LOCAL_UPDATE_QUEUE = Gauge("bot_local_update_queue_depth", "Updates waiting in this process")
+
+# Seconds spent per component by the handler call running in this task
+_breakdown = contextvars.ContextVar("metrics_breakdown", default=None)
+
+_profile = {"rate": PROFILE_SAMPLE_RATE, "active": False, "stats": None}
+_tasks = []
+_runner = None
+
+
+def _add_component_time(component, seconds):
+    breakdown = _breakdown.get()
+    if breakdown is not None:
+        breakdown[component] = breakdown.get(component, 0.0) + seconds
+
+
+def _row_count(result):
+    """Rows in a query function's result; scalars (ids, counts, flags) are not rows"""
+    if isinstance(result, (list, tuple, set, dict)):
+        return len(result)
+    # A single record
+    return 1 if hasattr(result, 'keys') else 0
+
+
+def instrument_queries(namespace, skip=()):
+    """Wrap every coroutine and async generator function in a module namespace with query metrics"""
+    for name, function in list(namespace.items()):
+        if name.startswith('_') or name in skip or getattr(function, '__module__', None) != namespace['__name__']:
+            continue
+        if inspect.isasyncgenfunction(function):
+            namespace[name] = _timed_generator(name, function)
+        elif inspect.iscoroutinefunction(function):
+            namespace[name] = _timed_query(name, function)
+
+
+def _timed_query(name, function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await function(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.labels(name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.labels(name).observe(elapsed)
+            _add_component_time('db', elapsed)
+        DB_ROWS.labels(name).inc(_row_count(result))
+        return result
+    return wrapper
+
+
+def _timed_generator(name, function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        # Only the time spent inside the generator counts, not the consumer's
+        elapsed = 0.0
+        rows = 0
+        generator = function(*args, **kwargs)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    chunk = await generator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - started
+                rows += _row_count(chunk)
+                yield chunk
+        except Exception:
+            DB_ERRORS.labels(name).inc()
+            raise
+        finally:
+            await generator.aclose()
+            DB_QUERY_SECONDS.labels(name).observe(elapsed)
+            DB_ROWS.labels(name).inc(rows)
+            _add_component_time('db', elapsed)
+    return wrapper
+
+
+def observe_llm(model, outcome, seconds, usage=None):
+    """Record one model request; usage is the completion's usage object, if any"""
+    LLM_SECONDS.labels(model, outcome).observe(seconds)
+    _add_component_time('llm', seconds)
+    if usage is not None:
+        LLM_TOKENS.labels(model, 'prompt').inc(getattr(usage, 'prompt_tokens', 0) or 0)
+        LLM_TOKENS.labels(model, 'completion').inc(getattr(usage, 'completion_tokens', 0) or 0)
+
+
+def observe_fallback(model):
+    """A lookup gave up on a model and goes on with the next one"""
+    LLM_FALLBACKS.labels(model).inc()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API request that records the latency of every call"""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, request_data, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_SECONDS.labels(url.rsplit('/', 1)[-1]).observe(elapsed)
+            _add_component_time('telegram', elapsed)
+
+
+async def _run_profiled(callback, update, context):
+    profiler = cProfile.Profile()
+    _profile["active"] = True
+    try:
+        profiler.enable()
+        try:
+            return await callback(update, context)
+        finally:
+            profiler.disable()
+    finally:
+        _profile["active"] = False
+        if _profile["stats"] is None:
+            _profile["stats"] = pstats.Stats(profiler)
+        else:
+            _profile["stats"].add(profiler)
+
+
+def _timed_handler(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        breakdown = {}
+        token = _breakdown.set(breakdown)
+        started = time.perf_counter()
+        try:
+            # Only one profiler can run at a time
+            if _profile["rate"] and not _profile["active"] and random.random() < _profile["rate"]:
+                return await _run_profiled(callback, update, context)
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _breakdown.reset(token)
+            HANDLER_SECONDS.labels(name).observe(elapsed)
+            for component, seconds in breakdown.items():
+                HANDLER_COMPONENT_SECONDS.labels(name, component).observe(seconds)
+            if elapsed >= METRICS_SLOW_HANDLER:
+                logger.warning(
+                    "Slow handler %s: %.2fs (db %.2fs, llm %.2fs, telegram %.2fs)", name, elapsed,
+                    breakdown.get('db', 0.0), breakdown.get('llm', 0.0), breakdown.get('telegram', 0.0),
+                )
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = [*handler.entry_points, *handler.fallbacks]
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for child in nested:
+            _instrument_handler(child)
+    elif not getattr(handler.callback, 'instrumented', False):
+        handler.callback = _timed_handler(handler.callback)
+
+
+def instrument_handlers(application):
+    """Time every handler registered on an application, including conversation states"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+async def _measure_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+
+
+async def _sample_queues(application):
+    # Imported here: database imports this module
+    import database
+    import definition_jobs
+
+    while True:
+        try:
+            stats = await definition_jobs.queue_stats()
+            DEFINITION_JOBS.labels('queued').set(stats["depth"])
+            DEFINITION_JOBS.labels('due').set(stats["due"])
+            DEFINITION_JOB_AGE.set(stats["oldest_age"])
+            queue = await database.get_update_queue_stats(datetime.now())
+            UPDATE_QUEUE_DEPTH.set(queue['depth'])
+            UPDATE_QUEUE_AGE.set(queue['oldest_age'])
+        except Exception:
+            logger.warning("Failed to sample queue depths", exc_info=True)
+        LOCAL_UPDATE_QUEUE.set(application.update_queue.qsize())
+        await asyncio.sleep(METRICS_SAMPLE_INTERVAL)
+
+
+async def metrics_endpoint(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def profile_stats(request):
+    stats = _profile["stats"]
+    if stats is None:
+        return web.Response(text=f"No profiled calls yet (sample rate {_profile['rate']})\n")
+    out = io.StringIO()
+    stats.stream = out
+    try:
+        stats.sort_stats(request.query.get("sort", "cumulative")).print_stats(50)
+    except KeyError:
+        return web.Response(status=400, text="Unknown sort key\n")
+    return web.Response(text=out.getvalue())
+
+
+async def profile_settings(request):
+    if "rate" in request.query:
+        try:
+            rate = float(request.query["rate"])
+        except ValueError:
+            return web.Response(status=400, text="rate must be a number between 0 and 1\n")
+        _profile["rate"] = min(max(rate, 0.0), 1.0)
+    if request.query.get("reset"):
+        _profile["stats"] = None
+    return web.Response(text=f"Profiling {_profile['rate']:.2%} of handler calls\n")
+
+
+def make_app():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_get("/debug/profile", profile_stats)
+    app.router.add_post("/debug/profile", profile_settings)
+    return app
+
+
+async def start(application):
+    """Start the samplers and the metrics server of this process"""
+    global _runner
+    _tasks.append(asyncio.create_task(_measure_loop_lag()))
+    _tasks.append(asyncio.create_task(_sample_queues(application)))
+    if not METRICS_PORT:
+        return
+    runner = web.AppRunner(make_app(), access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # E.g. several bot processes on one host: give each its own METRICS_PORT
+        logger.warning("Metrics server not started on %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+        await runner.cleanup()
+        return
+    _runner = runner
+
+
+async def stop():
+    global _runner
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
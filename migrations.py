@@ -0,0 +1,392 @@
+"""
+Versioned schema migrations.
+
+Each migration is applied once, in order, inside its own transaction and
+recorded in the schema_migrations table. To change the schema append a new
+entry to MIGRATIONS; never edit one that has already been deployed.
+"""
+
+# Arbitrary key for pg_advisory_lock so that concurrently starting bots
+# don't apply the same migration twice
+MIGRATION_LOCK_ID = 7_351_204
+
+MIGRATIONS = [
+    (1, "initial schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT PRIMARY KEY,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS words (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            word TEXT NOT NULL,
+            definition TEXT,
+            repetition_level INTEGER DEFAULT 0,
+            next_review_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        ''',
+    ]),
+    (2, "shared definitions cache", [
+        '''
+        CREATE TABLE IF NOT EXISTS definitions (
+            id SERIAL PRIMARY KEY,
+            word_key TEXT NOT NULL,
+            prompt_version TEXT NOT NULL,
+            definition TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (word_key, prompt_version)
+        )
+        ''',
+        '''
+        ALTER TABLE words
+        ADD COLUMN IF NOT EXISTS definition_id INTEGER REFERENCES definitions(id) ON DELETE SET NULL
+        ''',
+    ]),
+    (3, "indexes for per-user word lookups", [
+        # Due words and everything else filtered by user
+        'CREATE INDEX IF NOT EXISTS words_user_next_review_idx ON words (user_id, next_review_at)',
+        # Keep the oldest copy (and its progress) of words saved twice
+        '''
+        DELETE FROM words w
+        USING words older
+        WHERE w.user_id = older.user_id
+          AND LOWER(w.word) = LOWER(older.word)
+          AND w.id > older.id
+        ''',
+        # One entry per word and user; also serves exact case-insensitive lookups
+        'CREATE UNIQUE INDEX IF NOT EXISTS words_user_lower_word_key ON words (user_id, LOWER(word))',
+        # Trigram index for LIKE '%term%' searches. pg_trgm ships with every
+        # managed Postgres we deploy to; elsewhere search falls back to a scan.
+        '''
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS words_lower_word_trgm_idx ON words USING gin (LOWER(word) gin_trgm_ops);
+        EXCEPTION WHEN feature_not_supported OR undefined_file OR insufficient_privilege THEN
+            RAISE WARNING 'pg_trgm is not available, partial search will not use an index';
+        END
+        $$
+        ''',
+    ]),
+    (4, "index for paging through words", [
+        'CREATE INDEX IF NOT EXISTS words_user_created_idx ON words (user_id, created_at, id)',
+    ]),
+    (5, "per-user stats counters", [
+        # No writes to words while the counters are backfilled
+        'LOCK TABLE words IN SHARE ROW EXCLUSIVE MODE',
+        '''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+            total INTEGER NOT NULL DEFAULT 0,
+            new_words INTEGER NOT NULL DEFAULT 0,
+            learning INTEGER NOT NULL DEFAULT 0,
+            mastered INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        # Applies +1/-1 per changed row to the counters of its level bucket
+        '''
+        CREATE OR REPLACE FUNCTION apply_user_stats_delta(user_ids BIGINT[], levels INTEGER[], signs INTEGER[])
+        RETURNS void LANGUAGE sql AS $$
+            INSERT INTO user_stats AS s (user_id, total, new_words, learning, mastered)
+            SELECT
+                d.user_id,
+                SUM(d.sign),
+                COALESCE(SUM(d.sign) FILTER (WHERE d.level = 0), 0),
+                COALESCE(SUM(d.sign) FILTER (WHERE d.level BETWEEN 1 AND 2), 0),
+                COALESCE(SUM(d.sign) FILTER (WHERE d.level >= 3), 0)
+            FROM UNNEST(user_ids, levels, signs) AS d(user_id, level, sign)
+            WHERE d.user_id IS NOT NULL
+            GROUP BY d.user_id
+            ON CONFLICT (user_id) DO UPDATE SET
+                total = s.total + EXCLUDED.total,
+                new_words = s.new_words + EXCLUDED.new_words,
+                learning = s.learning + EXCLUDED.learning,
+                mastered = s.mastered + EXCLUDED.mastered
+        $$
+        ''',
+        # Inserted rows count +1 and deleted rows -1, an update counts as both.
+        # Runs once per statement, in the same transaction as the change to words.
+        '''
+        CREATE OR REPLACE FUNCTION words_update_user_stats() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM apply_user_stats_delta(array_agg(user_id), array_agg(repetition_level), array_agg(1))
+                FROM new_rows;
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM apply_user_stats_delta(array_agg(user_id), array_agg(repetition_level), array_agg(-1))
+                FROM old_rows;
+            ELSE
+                PERFORM apply_user_stats_delta(array_agg(user_id), array_agg(repetition_level), array_agg(sign))
+                FROM (
+                    SELECT user_id, repetition_level, 1 AS sign FROM new_rows
+                    UNION ALL
+                    SELECT user_id, repetition_level, -1 AS sign FROM old_rows
+                ) changed;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        ''',
+        'DROP TRIGGER IF EXISTS words_stats_insert ON words',
+        '''
+        CREATE TRIGGER words_stats_insert AFTER INSERT ON words
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION words_update_user_stats()
+        ''',
+        'DROP TRIGGER IF EXISTS words_stats_update ON words',
+        '''
+        CREATE TRIGGER words_stats_update AFTER UPDATE ON words
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION words_update_user_stats()
+        ''',
+        'DROP TRIGGER IF EXISTS words_stats_delete ON words',
+        '''
+        CREATE TRIGGER words_stats_delete AFTER DELETE ON words
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION words_update_user_stats()
+        ''',
+        '''
+        INSERT INTO user_stats (user_id, total, new_words, learning, mastered)
+        SELECT
+            user_id,
+            COUNT(*),
+            COUNT(*) FILTER (WHERE repetition_level = 0),
+            COUNT(*) FILTER (WHERE repetition_level BETWEEN 1 AND 2),
+            COUNT(*) FILTER (WHERE repetition_level >= 3)
+        FROM words
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO NOTHING
+        ''',
+    ]),
+    (6, "shared update queue and bot state", [
+        '''
+        CREATE TABLE IF NOT EXISTS update_queue (
+            id BIGSERIAL PRIMARY KEY,
+            partition INTEGER NOT NULL,
+            user_id BIGINT,
+            payload JSONB NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS update_queue_partition_idx ON update_queue (partition, id)',
+        '''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            partition INTEGER,
+            data BYTEA NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS bot_state_kind_partition_idx ON bot_state (kind, partition)',
+    ]),
+    (7, "background definition jobs", [
+        '''
+        CREATE TABLE IF NOT EXISTS definition_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            word_id INTEGER NOT NULL UNIQUE REFERENCES words(id) ON DELETE CASCADE,
+            word TEXT NOT NULL,
+            chat_id BIGINT,
+            message_id BIGINT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS definition_jobs_run_after_idx ON definition_jobs (run_after)',
+    ]),
+    (8, "scheduler state per word", [
+        'ALTER TABLE words ADD COLUMN IF NOT EXISTS ease REAL NOT NULL DEFAULT 2.5',
+        'ALTER TABLE words ADD COLUMN IF NOT EXISTS stability REAL',
+        'ALTER TABLE words ADD COLUMN IF NOT EXISTS difficulty REAL',
+        'ALTER TABLE words ADD COLUMN IF NOT EXISTS lapses INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE words ADD COLUMN IF NOT EXISTS last_review_at TIMESTAMP',
+        # Words reviewed under the fixed ladder: derive the last review from the ladder interval
+        '''
+        WITH ladder AS (
+            SELECT id, CASE repetition_level
+                WHEN 1 THEN 1 WHEN 2 THEN 3 WHEN 3 THEN 7 WHEN 4 THEN 14
+                ELSE LEAST(30 * POWER(2, LEAST(repetition_level - 5, 20)), 36500)
+            END AS days
+            FROM words
+            WHERE repetition_level > 0 AND next_review_at IS NOT NULL
+        )
+        UPDATE words
+        SET stability = ladder.days,
+            last_review_at = words.next_review_at - make_interval(days => ladder.days::int)
+        FROM ladder
+        WHERE words.id = ladder.id
+        ''',
+    ]),
+    (9, "review log and scheduler parameters", [
+        '''
+        CREATE TABLE IF NOT EXISTS review_log (
+            user_id BIGINT NOT NULL,
+            word_id INTEGER NOT NULL,
+            reviewed_at TIMESTAMP NOT NULL,
+            grade SMALLINT NOT NULL,
+            scheduler TEXT NOT NULL,
+            elapsed_days REAL,
+            prior_interval REAL,
+            stability_before REAL
+        ) PARTITION BY RANGE (reviewed_at)
+        ''',
+        'CREATE INDEX IF NOT EXISTS review_log_user_reviewed_idx ON review_log (user_id, reviewed_at)',
+        # Later months are added by database.ensure_review_log_partitions
+        '''
+        DO $$
+        DECLARE
+            month DATE := date_trunc('month', CURRENT_DATE);
+        BEGIN
+            FOR i IN 0..2 LOOP
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF review_log FOR VALUES FROM (%L) TO (%L)',
+                    'review_log_' || to_char(month + make_interval(months => i), 'YYYY_MM'),
+                    month + make_interval(months => i),
+                    month + make_interval(months => i + 1)
+                );
+            END LOOP;
+        END
+        $$
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS scheduler_params (
+            scheduler TEXT NOT NULL,
+            user_id BIGINT NOT NULL DEFAULT 0,
+            params JSONB NOT NULL,
+            reviews INTEGER NOT NULL,
+            log_loss REAL,
+            baseline_log_loss REAL,
+            fitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (scheduler, user_id)
+        )
+        ''',
+    ]),
+    (10, "trigram index on definitions", [
+        # For /search -d; without pg_trgm the search reads the user's words
+        '''
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                CREATE INDEX IF NOT EXISTS words_lower_definition_trgm_idx
+                    ON words USING gin (LOWER(definition) gin_trgm_ops);
+            END IF;
+        END
+        $$
+        ''',
+    ]),
+    (11, "rate limit buckets", [
+        # Shared token buckets (RATE_LIMIT_BACKEND=postgres); losing them in a crash only resets the limits
+        '''
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        )
+        ''',
+    ]),
+    (12, "user settings", [
+        # A constant default does not rewrite the table
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS settings JSONB NOT NULL DEFAULT '{}'",
+    ]),
+    (13, "review reminders", [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS last_reminded_at TIMESTAMP',
+    ]),
+    (14, "structured definitions", [
+        # Pronunciation, example and language of a structured definition; NULL for free-form text
+        'ALTER TABLE definitions ADD COLUMN IF NOT EXISTS details JSONB',
+        'ALTER TABLE words ADD COLUMN IF NOT EXISTS details JSONB',
+    ]),
+    (15, "review answer buffer", [
+        # Answers given in /train but not yet applied to words and review_log; kept small by the flushes
+        '''
+        CREATE TABLE IF NOT EXISTS review_answer_buffer (
+            seq BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            word_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            ease REAL NOT NULL,
+            stability REAL,
+            difficulty REAL,
+            lapses INTEGER NOT NULL,
+            last_review_at TIMESTAMP NOT NULL,
+            next_review_at TIMESTAMP NOT NULL,
+            grade SMALLINT NOT NULL,
+            scheduler TEXT NOT NULL,
+            elapsed_days REAL,
+            prior_interval REAL,
+            stability_before REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS review_answer_buffer_user_idx ON review_answer_buffer (user_id)',
+    ]),
+    (16, "stats trigger skips updates that keep the level", [
+        # Most updates of words (due dates, definitions, reschedules) leave the level alone;
+        # only rows whose level or owner changed touch user_stats
+        '''
+        CREATE OR REPLACE FUNCTION words_update_user_stats() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM apply_user_stats_delta(array_agg(user_id), array_agg(repetition_level), array_agg(1))
+                FROM new_rows;
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM apply_user_stats_delta(array_agg(user_id), array_agg(repetition_level), array_agg(-1))
+                FROM old_rows;
+            ELSE
+                PERFORM apply_user_stats_delta(array_agg(c.user_id), array_agg(c.level), array_agg(c.sign))
+                FROM new_rows n
+                JOIN old_rows o ON o.id = n.id
+                CROSS JOIN LATERAL (
+                    VALUES (n.user_id, n.repetition_level, 1), (o.user_id, o.repetition_level, -1)
+                ) AS c(user_id, level, sign)
+                WHERE n.repetition_level IS DISTINCT FROM o.repetition_level OR n.user_id IS DISTINCT FROM o.user_id
+                -- No such row: skip the call instead of upserting nothing
+                HAVING COUNT(*) > 0;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        ''',
+    ]),
+]
+
+
+async def migrate(conn):
+    """Apply all pending migrations, return the list of applied versions"""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    applied = []
+    await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+    try:
+        done = {row['version'] for row in await conn.fetch('SELECT version FROM schema_migrations')}
+        for version, name, statements in MIGRATIONS:
+            if version in done:
+                continue
+            async with conn.transaction():
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute(
+                    'INSERT INTO schema_migrations (version, name) VALUES ($1, $2)',
+                    version, name
+                )
+            print(f"Applied migration {version}: {name}")
+            applied.append(version)
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
+    return applied
@@ -0,0 +1,108 @@
+"""
+PostgreSQL-backed persistence for python-telegram-bot.
+
+user_data, chat_data, bot_data and conversation states are pickled into the
+bot_state table, so review sessions and half-finished /delete dialogs survive
+restarts and move with a user when another worker takes over their
+partition. A worker only loads the entries of the partitions it owns.
+"""
+import json
+import os
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import database
+import shared_queue
+
+# Seconds between writes of changed user/chat/bot data
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "5"))
+
+
+class PostgresPersistence(BasePersistence):
+    def __init__(self, partitions=None, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        # The bot does not use arbitrary callback_data, nothing to store for it
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval,
+        )
+        self.partitions = list(partitions) if partitions is not None else None
+        self._db_ready = False
+
+    async def _ensure_db(self):
+        # The application loads persisted data before post_init opens the pool
+        if not self._db_ready:
+            await database.init_db()
+            self._db_ready = True
+
+    async def _load(self, kind):
+        await self._ensure_db()
+        rows = await database.load_bot_state(kind, self.partitions)
+        return {row['key']: pickle.loads(row['data']) for row in rows}
+
+    async def _save(self, kind, key, partition, value):
+        await self._ensure_db()
+        await database.save_bot_state(kind, key, partition, pickle.dumps(value))
+
+    async def get_user_data(self):
+        return {int(key): data for key, data in (await self._load('user_data')).items()}
+
+    async def get_chat_data(self):
+        return {int(key): data for key, data in (await self._load('chat_data')).items()}
+
+    async def get_bot_data(self):
+        # bot_data is shared by all workers and not partitioned
+        await self._ensure_db()
+        rows = await database.load_bot_state('bot_data')
+        return pickle.loads(rows[0]['data']) if rows else {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        stored = await self._load(f'conversation:{name}')
+        return {tuple(json.loads(key)): state for key, state in stored.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        kind = f'conversation:{name}'
+        encoded = json.dumps(list(key))
+        if new_state is None:
+            await self._ensure_db()
+            await database.delete_bot_state(kind, encoded)
+        else:
+            # Keys are (chat_id, user_id) for the bot's handlers; the user decides the partition
+            await self._save(kind, encoded, shared_queue.partition_for(key[-1]), new_state)
+
+    async def update_user_data(self, user_id, data):
+        await self._save('user_data', str(user_id), shared_queue.partition_for(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._save('chat_data', str(chat_id), shared_queue.partition_for(chat_id), data)
+
+    async def update_bot_data(self, data):
+        await self._save('bot_data', '', None, data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        await self._ensure_db()
+        await database.delete_bot_state('user_data', str(user_id))
+
+    async def drop_chat_data(self, chat_id):
+        await self._ensure_db()
+        await database.delete_bot_state('chat_data', str(chat_id))
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Each user is handled by exactly one worker, the in-memory copy is authoritative
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # Every update_* call writes through, nothing is buffered here
+        pass
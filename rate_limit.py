@@ -0,0 +1,141 @@
+"""
+Token-bucket rate limits.
+
+Every user has a bucket of RATE_LIMIT_BURST tokens refilled at
+RATE_LIMIT_PER_MINUTE per minute. A message costs one token, a button
+press RATE_LIMIT_CALLBACK_COST; an update that finds the bucket empty gets
+a short "slow down" reply and is not handled. Model lookups share one
+bucket of LLM_BUDGET_PER_MINUTE (0 = unlimited), see ai_client.
+
+Buckets live in process memory by default. That is exact when one process
+sees all of a user's updates (a single bot, or BOT_ROLE=worker, where each
+user belongs to one worker). With RATE_LIMIT_BACKEND=postgres they are rows
+of an UNLOGGED table shared by every process, e.g. several webhook
+instances behind a load balancer. The model lookup budget is only shared
+by every process with the postgres backend.
+"""
+import logging
+import os
+import time
+from datetime import datetime
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+import database
+import metrics
+
+# memory or postgres
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+# Updates a user may send at once
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+# Tokens refilled per user per minute (0 disables the per-user limit)
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "30"))
+# Button presses are cheap, a /train session should never hit the limit
+RATE_LIMIT_CALLBACK_COST = float(os.getenv("RATE_LIMIT_CALLBACK_COST", "0.25"))
+# Model lookups per minute across all users (0 = unlimited); per process unless RATE_LIMIT_BACKEND=postgres
+LLM_BUDGET_PER_MINUTE = float(os.getenv("LLM_BUDGET_PER_MINUTE", "0"))
+
+# A limited user is told at most once per this many seconds, later updates are dropped silently
+NOTICE_INTERVAL = 10.0
+# Buckets kept in memory before the full ones are forgotten
+MAX_BUCKETS = 100_000
+
+LLM_BUDGET_KEY = "llm"
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBuckets:
+    """Token buckets in a dict: key -> (tokens, monotonic time of the last update)"""
+
+    def __init__(self):
+        self._buckets = {}
+
+    def take(self, key, capacity, per_second, cost):
+        """Take cost tokens; returns 0 if they were taken, otherwise seconds until they will be there"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * per_second)
+        if tokens < cost:
+            return (cost - tokens) / per_second
+        self._buckets[key] = (tokens - cost, now)
+        if len(self._buckets) > MAX_BUCKETS:
+            self._forget_full(capacity, per_second, now)
+        return 0.0
+
+    def _forget_full(self, capacity, per_second, now):
+        # A full bucket is the same as a missing one
+        self._buckets = {
+            key: (tokens, updated) for key, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * per_second < capacity
+        }
+
+
+_memory = MemoryBuckets()
+_notified = {}
+
+
+async def take(key, capacity, per_minute, cost=1.0):
+    """Take cost tokens from a bucket; returns 0 if allowed, otherwise about how many seconds to wait"""
+    if RATE_LIMIT_BACKEND == "postgres":
+        return await take_shared(key, capacity, per_minute, cost)
+    return _memory.take(key, capacity, per_minute / 60, cost)
+
+
+async def take_shared(key, capacity, per_minute, cost=1.0):
+    """Like take, but always from the PostgreSQL bucket shared by every process"""
+    per_second = per_minute / 60
+    left = await database.take_rate_limit_tokens(key, capacity, per_second, cost, datetime.now())
+    # The shared bucket does not say how empty it is, assume it is empty
+    return 0.0 if left is not None else cost / per_second
+
+
+async def take_llm_budget():
+    """Take one model lookup from the global budget; returns 0 if it fits, otherwise seconds to wait"""
+    if LLM_BUDGET_PER_MINUTE <= 0:
+        return 0.0
+    # Up to a minute's worth of lookups may be spent at once
+    return await take(LLM_BUDGET_KEY, LLM_BUDGET_PER_MINUTE, LLM_BUDGET_PER_MINUTE)
+
+
+def _should_notify(user_id):
+    now = time.monotonic()
+    if now - _notified.get(user_id, float('-inf')) < NOTICE_INTERVAL:
+        return False
+    if len(_notified) > MAX_BUCKETS:
+        _notified.clear()
+    _notified[user_id] = now
+    return True
+
+
+async def _check(update: Update, context):
+    user = update.effective_user
+    if user is None:
+        return
+    kind = "callback" if update.callback_query else "message"
+    cost = RATE_LIMIT_CALLBACK_COST if update.callback_query else 1.0
+    try:
+        wait = await take(f"user:{user.id}", RATE_LIMIT_BURST, RATE_LIMIT_PER_MINUTE, cost)
+    except Exception:
+        # Better to serve everyone than no one while the limiter is broken
+        logger.exception("Rate limiter failed, letting the update through")
+        return
+    if not wait:
+        return
+
+    metrics.RATE_LIMITED.labels(kind).inc()
+    text = f"⏳ Слишком много запросов. Подождите {max(1, round(wait))} сек. и попробуйте снова."
+    if update.callback_query:
+        # Answering is required anyway, it also stops the button's spinner
+        await update.callback_query.answer(text)
+    elif update.effective_message and _should_notify(user.id):
+        await update.effective_message.reply_text(text)
+    raise ApplicationHandlerStop
+
+
+def add_handler(application):
+    """Check every update against its user's bucket before any other handler"""
+    if RATE_LIMIT_PER_MINUTE <= 0:
+        return
+    application.add_handler(TypeHandler(Update, _check), group=-1)
@@ -0,0 +1,172 @@
+"""
+Reminders about words due for review.
+
+Every REMINDER_CHECK_INTERVAL a JobQueue tick starts one background pass
+over the users table (unless the previous pass is still sending). The pass
+claims users in batches of REMINDER_BATCH_SIZE, walking users.id forward.
+One UPDATE ... RETURNING per batch picks the users who have due words, were
+not reminded within REMINDER_EVERY_HOURS and did not turn reminders off. It
+stamps their last_reminded_at. SKIP LOCKED lets every bot process run the
+job without reminding anyone twice.
+
+Messages go through a sender paced to REMINDER_RATE messages per second for
+the whole bot, counted in a token bucket in PostgreSQL that every process
+shares, and one per second per chat, below Telegram's limits (30 and 1), so
+interactive replies still get through. A user who blocked the bot
+gets reminders turned off.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+import database
+import metrics
+import users
+import rate_limit
+
+# Seconds between checks for users to remind (0 disables reminders)
+REMINDER_CHECK_INTERVAL = float(os.getenv("REMINDER_CHECK_INTERVAL", "900"))
+# Least hours between two reminders to the same user
+REMINDER_EVERY_HOURS = float(os.getenv("REMINDER_EVERY_HOURS", "24"))
+# Reminders sent per second by all bot processes together
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", "20"))
+# Users claimed per query
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "500"))
+
+# Due words are counted up to this many ("100+")
+MAX_DUE_COUNT = 100
+# Least seconds between two messages to one chat
+CHAT_INTERVAL = 1.0
+# Shared token bucket of all reminder senders, see rate_limit.take_shared
+REMINDER_BUCKET_KEY = "reminders"
+
+logger = logging.getLogger(__name__)
+
+_pass = None
+
+
+class RateLimitedSender:
+    """
+    Paces messages to at most `rate` per second across every process sending
+    with the same bucket key, and one per CHAT_INTERVAL per chat. A chat's
+    reminder is only ever sent by the process that claimed it, so the chat
+    buckets stay in memory. The caller awaits wait_turn for one message at a
+    time, then sends it without waiting for the previous ones to finish.
+    """
+
+    def __init__(self, bot, rate, key=REMINDER_BUCKET_KEY):
+        self.bot = bot
+        self.rate = rate
+        self.key = key
+        self._buckets = rate_limit.MemoryBuckets()
+        self._paused_until = 0.0
+
+    async def wait_turn(self, chat_id):
+        loop = asyncio.get_running_loop()
+        if self._paused_until > loop.time():
+            await asyncio.sleep(self._paused_until - loop.time())
+        while wait := await rate_limit.take_shared(self.key, self.rate, self.rate * 60):
+            await asyncio.sleep(wait)
+        while wait := self._buckets.take(chat_id, 1, 1 / CHAT_INTERVAL, 1):
+            await asyncio.sleep(wait)
+
+    async def send(self, chat_id, text, **kwargs):
+        """Send right away; on flood control pause every later turn, wait it out and retry once"""
+        try:
+            return await self.bot.send_message(chat_id, text, **kwargs)
+        except RetryAfter as e:
+            delay = _seconds(e.retry_after)
+            logger.warning("Flood control, pausing reminders for %ss", delay)
+            self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + delay)
+            await asyncio.sleep(delay)
+            return await self.bot.send_message(chat_id, text, **kwargs)
+
+
+def _seconds(retry_after):
+    # A timedelta in newer python-telegram-bot versions, an int in older ones
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+
+
+def reminder_text(due):
+    count = f"{due}+" if due >= MAX_DUE_COUNT else str(due)
+    return (
+        f"🔔 Пора повторить слова! Ждут повторения: {count}.\n\n"
+        "Начать тренировку: /train\n"
+        "Отключить напоминания: /reminders off"
+    )
+
+
+async def _remind(sender, user_id, due):
+    try:
+        await sender.send(user_id, reminder_text(due))
+    except (Forbidden, BadRequest) as e:
+        # Blocked the bot or the chat is gone: stop trying
+        logger.info("Turning reminders off for %s: %s", user_id, e)
+        metrics.REMINDERS.labels("blocked").inc()
+        try:
+            await users.update_settings(user_id, reminders=False)
+        except Exception:
+            logger.exception("Could not turn reminders off for %s", user_id)
+    except TelegramError as e:
+        logger.warning("Could not remind %s: %s", user_id, e)
+        metrics.REMINDERS.labels("error").inc()
+    else:
+        metrics.REMINDERS.labels("sent").inc()
+
+
+async def send_due_reminders(bot):
+    """Remind every user with due words who has not been reminded lately; returns how many were claimed"""
+    sender = RateLimitedSender(bot, REMINDER_RATE)
+    claimed = 0
+    after_id = None
+    tasks = set()
+    try:
+        while True:
+            now = datetime.now()
+            batch = await database.claim_reminders(
+                now, now - timedelta(hours=REMINDER_EVERY_HOURS), after_id, REMINDER_BATCH_SIZE, MAX_DUE_COUNT
+            )
+            if not batch:
+                break
+            claimed += len(batch)
+            after_id = max(row['id'] for row in batch)
+            # The next batch is claimed once this one is sent, so a crash loses at most one batch
+            for row in batch:
+                await sender.wait_turn(row['id'])
+                task = asyncio.create_task(_remind(sender, row['id'], row['due']))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return claimed
+
+
+async def _run_pass(bot):
+    try:
+        started = datetime.now()
+        claimed = await send_due_reminders(bot)
+        if claimed:
+            logger.info("Sent %s reminders in %s", claimed, datetime.now() - started)
+    except Exception:
+        logger.exception("Reminder pass failed")
+
+
+async def tick(context):
+    """JobQueue callback: start a pass unless the previous one is still sending"""
+    global _pass
+    if _pass is not None and not _pass.done():
+        return
+    _pass = asyncio.create_task(_run_pass(context.bot))
+
+
+async def stop():
+    """Stop a running pass; users it had claimed but not reminded yet are skipped until next time"""
+    if _pass is not None and not _pass.done():
+        _pass.cancel()
+        await asyncio.gather(_pass, return_exceptions=True)
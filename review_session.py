@@ -0,0 +1,151 @@
+"""
+Per-user review sessions kept in context.user_data.
+
+A session holds a prefetched batch of due cards with their scheduling
+state. Each answer is stored right away in the small review_answer_buffer
+table, so a crash loses none of them, and applied to words in one statement
+when enough of them pile up, when the batch runs out, periodically from the
+job queue and on shutdown. The periodic flush also applies answers left by
+a process that died. Every answer also goes to the review log, which
+scheduler_optimizer fits interval scales from.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+import database
+import scheduler_optimizer
+
+# Due cards loaded per batch
+REVIEW_BATCH_SIZE = int(os.getenv("REVIEW_BATCH_SIZE", "50"))
+# Apply answers to words once this many are buffered
+REVIEW_FLUSH_SIZE = int(os.getenv("REVIEW_FLUSH_SIZE", "20"))
+# Seconds between background flushes of every session
+REVIEW_FLUSH_INTERVAL = float(os.getenv("REVIEW_FLUSH_INTERVAL", "30"))
+
+SESSION_KEY = 'review_session'
+
+logger = logging.getLogger(__name__)
+
+
+def get(user_data):
+    """Current session or None"""
+    return user_data.get(SESSION_KEY)
+
+
+async def start(user_data, user_id):
+    """Flush what is left of the previous session and load a fresh batch"""
+    session = user_data.get(SESSION_KEY)
+    if session is None:
+        session = {'user_id': user_id, 'queue': [], 'buffered': 0}
+        user_data[SESSION_KEY] = session
+    # None falls back to the scheduler's global scale
+    session['stability_scale'] = await scheduler_optimizer.user_scale(user_id)
+    await refill(session)
+    return session
+
+
+async def refill(session):
+    """Save buffered answers, then load the next batch of due cards"""
+    await flush(session)
+    rows = await database.get_due_batch(session['user_id'], REVIEW_BATCH_SIZE)
+    session['queue'] = [card_from_row(row) for row in rows]
+    return session['queue']
+
+
+def card_from_row(row):
+    """Review card with the word's scheduling state"""
+    return {
+        'id': row['id'],
+        'word': row['word'],
+        'level': row['repetition_level'],
+        'ease': row['ease'],
+        'stability': row['stability'],
+        'difficulty': row['difficulty'],
+        'lapses': row['lapses'],
+        'last_review_at': row['last_review_at'],
+        'next_review_at': row['next_review_at'],
+    }
+
+
+def current_card(session):
+    return session['queue'][0] if session['queue'] else None
+
+
+def take_card(session, word_id):
+    """Remove a card from the queue and return it (None if it is not there)"""
+    for idx, card in enumerate(session['queue']):
+        if card['id'] == word_id:
+            return session['queue'].pop(idx)
+    return None
+
+
+def _days(delta):
+    return delta / timedelta(days=1)
+
+
+async def record_answer(session, card, new_state, is_correct, scheduler_name):
+    """
+    Buffer an answer with its review log fields and carry the new state on the
+    card in case it comes up again
+    """
+    reviewed_at = new_state['last_review_at']
+    last_review_at = card.get('last_review_at')
+    next_review_at = card.get('next_review_at')
+    elapsed_days = prior_interval = None
+    if last_review_at is not None:
+        elapsed_days = _days(reviewed_at - last_review_at)
+        if next_review_at is not None:
+            prior_interval = _days(next_review_at - last_review_at)
+    await database.buffer_review_answer(session['user_id'], dict(
+        new_state,
+        id=card['id'],
+        grade=scheduler_optimizer.GRADE_GOOD if is_correct else scheduler_optimizer.GRADE_AGAIN,
+        scheduler=scheduler_name,
+        elapsed_days=elapsed_days,
+        prior_interval=prior_interval,
+        stability_before=card.get('stability'),
+    ))
+    # Sessions saved before answers were buffered in the database have no counter
+    session['buffered'] = session.get('buffered', 0) + 1
+    # A forgotten card comes back in this session and is due right away
+    card.update(new_state, next_review_at=reviewed_at)
+
+
+def needs_flush(session):
+    return session.get('buffered', 0) >= REVIEW_FLUSH_SIZE
+
+
+async def flush(session):
+    """Apply the user's buffered answers"""
+    flushed = await database.flush_review_answers(session['user_id'])
+    session['buffered'] = 0
+    return flushed
+
+
+async def flush_all(application):
+    """Apply every user's buffered answers, also those of sessions in other or dead processes"""
+    flushed = 0
+    done = set()
+    for user_id in await database.get_buffered_review_users():
+        try:
+            flushed += await database.flush_review_answers(user_id)
+            done.add(user_id)
+        except Exception:
+            logger.exception("Failed to save review answers of user %s", user_id)
+    # A copy: updates of new users add to user_data while this awaits
+    for user_data in list(application.user_data.values()):
+        session = user_data.get(SESSION_KEY)
+        if session and session['user_id'] in done:
+            session['buffered'] = 0
+    return flushed
+
+
+async def flush_job(context):
+    """JobQueue callback"""
+    await flush_all(context.application)
+
+
+async def ensure_log_partitions(context=None):
+    """Create the review log partitions for this and the next months (also a JobQueue callback)"""
+    await database.ensure_review_log_partitions(datetime.now())
@@ -0,0 +1,138 @@
+"""
+Fitting scheduler parameters from the review log.
+
+Every answer is logged with the card's stability before the answer and the
+days since its previous review. Under the FSRS forgetting curve a card with
+stability S is recalled after t days with probability
+
+    R = (1 + 19/81 * t / (k * S)) ** -0.5
+
+where k = 1 means the scheduler's stabilities are right. The optimizer
+streams the log in chunks, evaluates the log-loss of every k on a
+log-spaced grid for all answers at once with NumPy and keeps the best one,
+globally and (optionally) per user with enough reviews. Intervals are then
+multiplied by k: k > 1 means words are remembered longer than planned and
+can be shown less often without hurting retention.
+
+Run it offline with `python manage.py optimize-scheduler`.
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import database
+import spaced_repetition
+
+GRADE_AGAIN = spaced_repetition.FSRSScheduler.AGAIN
+GRADE_GOOD = spaced_repetition.FSRSScheduler.GOOD
+
+# Fewest logged answers a fit is based on, globally and per user
+OPTIMIZER_MIN_REVIEWS = int(os.getenv("OPTIMIZER_MIN_REVIEWS", "200"))
+# Log rows streamed at a time
+OPTIMIZER_CHUNK_SIZE = 50_000
+
+# Candidate scales from 1/4 to 4, 1.0 (the current schedule) in the middle
+SCALE_GRID = np.exp2(np.linspace(-2, 2, 49))
+BASELINE_INDEX = int(np.argmin(np.abs(SCALE_GRID - 1.0)))
+
+GLOBAL_USER = 0
+
+
+def _chunk_losses(elapsed_days, stability, recalled):
+    """Log-loss of every answer (rows) under every candidate scale (columns)"""
+    ratio = elapsed_days[:, None] / (stability[:, None] * SCALE_GRID[None, :])
+    recall = np.power(1 + spaced_repetition.FSRSScheduler.FACTOR * ratio, spaced_repetition.FSRSScheduler.DECAY)
+    recall = np.clip(recall, 1e-6, 1 - 1e-6)
+    return -np.where(recalled[:, None], np.log(recall), np.log1p(-recall))
+
+
+def _result(losses, reviews):
+    best = int(np.argmin(losses))
+    return {
+        "stability_scale": float(SCALE_GRID[best]),
+        "reviews": int(reviews),
+        "log_loss": float(losses[best] / reviews),
+        "baseline_log_loss": float(losses[BASELINE_INDEX] / reviews),
+    }
+
+
+async def fit(scheduler_name, since, per_user=False):
+    """
+    Fit the stability scale of a scheduler from answers logged since a date.
+    Returns the global result (None with too few reviews) and a dict of
+    per-user results.
+    """
+    total = np.zeros(len(SCALE_GRID))
+    reviews = 0
+    user_totals = {}
+    user_reviews = {}
+
+    async for rows in database.iter_review_log(scheduler_name, since, OPTIMIZER_CHUNK_SIZE):
+        users = np.fromiter((row['user_id'] for row in rows), dtype=np.int64, count=len(rows))
+        elapsed_days = np.fromiter((row['elapsed_days'] for row in rows), dtype=np.float64, count=len(rows))
+        stability = np.fromiter((row['stability_before'] for row in rows), dtype=np.float64, count=len(rows))
+        recalled = np.fromiter((row['grade'] > GRADE_AGAIN for row in rows), dtype=bool, count=len(rows))
+
+        losses = _chunk_losses(elapsed_days, stability, recalled)
+        total += losses.sum(axis=0)
+        reviews += len(rows)
+
+        if per_user:
+            user_ids, index = np.unique(users, return_inverse=True)
+            sums = np.column_stack([
+                np.bincount(index, weights=losses[:, g], minlength=len(user_ids))
+                for g in range(len(SCALE_GRID))
+            ])
+            counts = np.bincount(index, minlength=len(user_ids))
+            for i, user_id in enumerate(user_ids.tolist()):
+                if user_id in user_totals:
+                    user_totals[user_id] += sums[i]
+                    user_reviews[user_id] += int(counts[i])
+                else:
+                    user_totals[user_id] = sums[i]
+                    user_reviews[user_id] = int(counts[i])
+
+    global_result = _result(total, reviews) if reviews >= OPTIMIZER_MIN_REVIEWS else None
+    user_results = {
+        user_id: _result(losses, user_reviews[user_id])
+        for user_id, losses in user_totals.items()
+        if user_reviews[user_id] >= OPTIMIZER_MIN_REVIEWS
+    }
+    return global_result, user_results
+
+
+async def optimize(scheduler_name=None, since_days=None, per_user=False):
+    """Fit and store the parameters; returns what fit() returned"""
+    scheduler = spaced_repetition.get_scheduler(scheduler_name)
+    since = datetime.now() - timedelta(days=since_days) if since_days else datetime.min
+    global_result, user_results = await fit(scheduler.name, since, per_user)
+
+    results = dict(user_results)
+    if global_result is not None:
+        results[GLOBAL_USER] = global_result
+    for user_id, result in results.items():
+        await database.save_scheduler_params(
+            scheduler.name, user_id, json.dumps({"stability_scale": result["stability_scale"]}),
+            result["reviews"], result["log_loss"], result["baseline_log_loss"],
+        )
+    return global_result, user_results
+
+
+def _scale(params):
+    return json.loads(params).get("stability_scale") if params else None
+
+
+async def load_global_params(scheduler_name=None):
+    """Apply the stored global fit to a scheduler (the active one by default)"""
+    scheduler = spaced_repetition.get_scheduler(scheduler_name)
+    scale = _scale(await database.get_scheduler_params(scheduler.name, GLOBAL_USER))
+    if scale is not None:
+        scheduler.stability_scale = scale
+    return scheduler.stability_scale
+
+
+async def user_scale(user_id):
+    """A user's own fitted scale for the active scheduler, or None"""
+    return _scale(await database.get_scheduler_params(spaced_repetition.get_scheduler().name, user_id))
@@ -0,0 +1,198 @@
+"""
+Multi-worker deployment: updates go through a queue in PostgreSQL.
+
+    BOT_ROLE=ingress   receives updates (polling or webhook, see BOT_MODE)
+                       and only appends them to update_queue
+    BOT_ROLE=worker    runs the handlers for the partitions it owns
+
+Every update lands in partition user_id % QUEUE_PARTITIONS. Worker
+WORKER_INDEX of WORKER_COUNT owns the partitions p with
+p % WORKER_COUNT == WORKER_INDEX and holds an advisory lock on each of them,
+so a misconfigured second copy fails to start instead of answering twice.
+Within a partition every user has their own chain of updates, handled
+strictly in arrival order, and chains of different users run concurrently:
+a slow handler (an import, an export, a streamed definition) only holds up
+its own user. Up to QUEUE_BATCH_SIZE updates of a partition are taken at a
+time, and more are read as soon as some of them are done.
+
+A chain deletes its user's updates once they were handled, so a crashed
+worker redelivers the updates it had taken but not finished (at-least-once).
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+import database
+
+# Fixed for the lifetime of the queue: changing it moves users between partitions
+QUEUE_PARTITIONS = int(os.getenv("QUEUE_PARTITIONS", "64"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+# Updates of a partition being handled at a time
+QUEUE_BATCH_SIZE = int(os.getenv("QUEUE_BATCH_SIZE", "100"))
+# Seconds between checks of an idle partition in case a notification was missed
+QUEUE_POLL_INTERVAL = float(os.getenv("QUEUE_POLL_INTERVAL", "30"))
+
+# First key of the two-key advisory locks taken on partitions
+PARTITION_LOCK_NAMESPACE = 7_351_205
+
+logger = logging.getLogger(__name__)
+
+
+def partition_for(user_id):
+    return (user_id or 0) % QUEUE_PARTITIONS
+
+
+def owned_partitions(index=WORKER_INDEX, count=WORKER_COUNT):
+    if not 0 <= index < count:
+        raise ValueError(f"WORKER_INDEX must be between 0 and {count - 1}, got {index}")
+    return [p for p in range(QUEUE_PARTITIONS) if p % count == index]
+
+
+async def _enqueue(update: Update, context):
+    user_id = update.effective_user.id if update.effective_user else None
+    await database.enqueue_update(partition_for(user_id), user_id, json.dumps(update.to_dict()))
+    raise ApplicationHandlerStop
+
+
+def add_ingress_handler(application):
+    """Forward every update to the shared queue instead of handling it here"""
+    application.add_handler(TypeHandler(Update, _enqueue), group=-1)
+
+
+async def _handle_user_updates(application, rows):
+    for row in rows:
+        try:
+            update = Update.de_json(json.loads(row['payload']), application.bot)
+            await application.process_update(update)
+        except Exception:
+            # Handler errors go to the error handlers; this is a broken payload, skip it
+            logger.exception("Failed to process queued update %s", row['id'])
+
+
+async def _delete_handled(partition, rows):
+    while True:
+        try:
+            await database.delete_queued_updates([row['id'] for row in rows])
+            return
+        except Exception:
+            # Handled updates must not be handled again, keep trying
+            logger.exception("Failed to remove handled updates of partition %s", partition)
+            await asyncio.sleep(1)
+
+
+async def _consume_partition(application, partition, wakeup, stopping):
+    # Taken but not yet handled updates by user; a user with updates here has a running chain
+    pending = {}
+    chains = {}
+    # IDs of taken updates that are still in the queue
+    taken = set()
+
+    async def run_chain(user_id):
+        try:
+            while pending[user_id]:
+                rows, pending[user_id] = pending[user_id], []
+                await _handle_user_updates(application, rows)
+                await _delete_handled(partition, rows)
+                taken.difference_update(row['id'] for row in rows)
+                # Room for more updates
+                wakeup.set()
+        finally:
+            del pending[user_id]
+            del chains[user_id]
+
+    while not stopping.is_set():
+        # Cleared before reading so a notification arriving meanwhile is not lost
+        wakeup.clear()
+        rows = []
+        room = QUEUE_BATCH_SIZE - len(taken)
+        if room > 0:
+            try:
+                rows = await database.fetch_queued_updates(partition, room, taken)
+            except Exception:
+                logger.exception("Failed to read partition %s", partition)
+
+        if not rows:
+            try:
+                await asyncio.wait_for(wakeup.wait(), QUEUE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        for row in rows:
+            taken.add(row['id'])
+            pending.setdefault(row['user_id'], []).append(row)
+            if row['user_id'] not in chains:
+                chains[row['user_id']] = asyncio.create_task(run_chain(row['user_id']))
+
+    # Finish the updates already taken
+    await asyncio.gather(*list(chains.values()), return_exceptions=True)
+
+
+async def run_worker(application):
+    """Handle queued updates of this worker's partitions until SIGTERM/SIGINT"""
+    partitions = owned_partitions()
+    stopping = asyncio.Event()
+    wakeups = {partition: asyncio.Event() for partition in partitions}
+
+    def on_notify(connection, pid, channel, payload):
+        wakeup = wakeups.get(int(payload))
+        if wakeup is not None:
+            wakeup.set()
+
+    def on_lost(connection):
+        # The partition locks went with the connection, let the supervisor restart us
+        logger.error("Lost the queue listener connection, stopping")
+        stopping.set()
+
+    # Dedicated connection: it holds the partition locks and receives notifications
+    listener = await database.connect()
+    try:
+        for partition in partitions:
+            locked = await listener.fetchval(
+                'SELECT pg_try_advisory_lock($1, $2)', PARTITION_LOCK_NAMESPACE, partition
+            )
+            if not locked:
+                raise RuntimeError(
+                    f"Partition {partition} is owned by another worker, check WORKER_INDEX/WORKER_COUNT"
+                )
+        await listener.add_listener('update_queue', on_notify)
+        listener.add_termination_listener(on_lost)
+
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        print(f"Worker {WORKER_INDEX}/{WORKER_COUNT} is running ({len(partitions)} partitions)...")
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stopping.set)
+
+        consumers = [
+            asyncio.create_task(_consume_partition(application, partition, wakeups[partition], stopping))
+            for partition in partitions
+        ]
+        try:
+            await stopping.wait()
+        finally:
+            logger.info("Shutting down: finishing updates already taken")
+            for wakeup in wakeups.values():
+                wakeup.set()
+            await asyncio.gather(*consumers, return_exceptions=True)
+
+            if application.running:
+                await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+    finally:
+        listener.remove_termination_listener(on_lost)
+        await listener.close()
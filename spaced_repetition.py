@@ -1,9 +1,264 @@
+"""
+Review schedulers.
+
+Every scheduler turns a card's state and an answer ("I know it" / "I forgot")
+into the card's next state and due date, and can recompute the due dates of
+many cards at once with NumPy, e.g. after a parameter change:
+
+    ladder  fixed intervals by level (1, 3, 7, 14, 30, 60... days), a miss resets the level
+    sm2     SuperMemo-2: intervals grow by a per-card ease factor that drops on every miss
+    fsrs    FSRS-4.5: per-card stability and difficulty, intervals aim at a target recall probability
+
+Card state, as stored in the words table:
+
+    level           successful reviews in a row (0 = new or just forgotten)
+    ease            SM-2 ease factor
+    stability       days until recall probability falls to the target (FSRS), current interval otherwise
+    difficulty      FSRS difficulty, 1..10
+    lapses          how many times the card was forgotten
+    last_review_at  when it was last answered
+
+SCHEDULER picks the one used for new answers. Every interval is multiplied
+by a stability scale (1.0 unless scheduler_optimizer fitted one from the
+review log), globally or per user.
+"""
+import math
+import os
 from datetime import datetime, timedelta
 
+import numpy as np
+
+SCHEDULER = os.getenv("SCHEDULER", "ladder").lower()
+# Longest interval any scheduler may give, days
+MAX_INTERVAL_DAYS = float(os.getenv("SCHEDULER_MAX_INTERVAL", "36500"))
+# FSRS: recall probability at which a card becomes due
+FSRS_DESIRED_RETENTION = float(os.getenv("FSRS_DESIRED_RETENTION", "0.9"))
+
+DEFAULT_EASE = 2.5
+DAY = np.timedelta64(86_400_000_000, 'us')
+
+
+def _as_arrays(cards):
+    """Column arrays of card states; missing stability/difficulty become NaN"""
+    def column(key, default, dtype):
+        return np.array([default if card.get(key) is None else card[key] for card in cards], dtype=dtype)
+
+    return {
+        'level': column('level', 0, np.int64),
+        'ease': column('ease', DEFAULT_EASE, np.float64),
+        'stability': column('stability', np.nan, np.float64),
+        'difficulty': column('difficulty', np.nan, np.float64),
+        'lapses': column('lapses', 0, np.int64),
+    }
+
+
+def _elapsed_days(cards, now):
+    return np.array([
+        (now - card['last_review_at']) / timedelta(days=1) if card.get('last_review_at') else 0.0
+        for card in cards
+    ], dtype=np.float64)
+
+
+class Scheduler:
+    """Base class: subclasses implement review_batch and interval_days on column arrays"""
+
+    name = None
+    # Multiplies every interval; set from fitted parameters, see scheduler_optimizer
+    stability_scale = 1.0
+
+    def review_batch(self, state, correct, elapsed_days):
+        """New state arrays after answering; correct is a boolean array"""
+        raise NotImplementedError
+
+    def interval_days(self, state):
+        """Days from the last review to the next one for the given states"""
+        raise NotImplementedError
+
+    def review(self, card, is_correct, now=None, scale=None):
+        """
+        Answer one card, return its new state with next_review_at and last_review_at.
+        scale overrides the scheduler's stability_scale, e.g. with a user's own.
+        """
+        now = now or datetime.now()
+        scale = self.stability_scale if scale is None else scale
+        state = self.review_batch(_as_arrays([card]), np.array([is_correct]), _elapsed_days([card], now))
+        interval = float(np.clip(self.interval_days(state) * scale, 0, MAX_INTERVAL_DAYS)[0])
+
+        def scalar(key):
+            value = state[key][0].item()
+            return None if isinstance(value, float) and math.isnan(value) else value
+
+        return {
+            'level': scalar('level'),
+            'ease': scalar('ease'),
+            'stability': scalar('stability'),
+            'difficulty': scalar('difficulty'),
+            'lapses': scalar('lapses'),
+            'last_review_at': now,
+            'next_review_at': now + timedelta(days=interval),
+        }
+
+    def due_dates(self, state, last_review_at, scale=None):
+        """Vectorized: next review times (datetime64[us]) from state arrays and last review times"""
+        scale = self.stability_scale if scale is None else scale
+        interval = np.clip(self.interval_days(state) * scale, 0, MAX_INTERVAL_DAYS)
+        return last_review_at + (interval * DAY.astype(np.float64)).astype('timedelta64[us]')
+
+
+class LadderScheduler(Scheduler):
+    """The bot's original fixed ladder"""
+
+    name = "ladder"
+
+    def review_batch(self, state, correct, elapsed_days):
+        level = np.where(correct, state['level'] + 1, 0)
+        lapses = state['lapses'] + ((~correct) & (state['level'] > 0))
+        new_state = dict(state, level=level, lapses=lapses)
+        new_state['stability'] = self.interval_days(new_state).astype(np.float64)
+        return new_state
+
+    def interval_days(self, state):
+        level = state['level']
+        # 2**(level - 5) only matters for levels above 4, keep the exponent small elsewhere
+        growth = 30.0 * np.exp2(np.clip(level - 5, 0, 64))
+        return np.select(
+            [level <= 0, level == 1, level == 2, level == 3, level == 4],
+            [0.0, 1.0, 3.0, 7.0, 14.0],
+            growth,
+        )
+
+
+class SM2Scheduler(Scheduler):
+    """SuperMemo-2 with the two answers mapped to grades SM2_PASS_GRADE and SM2_FAIL_GRADE"""
+
+    name = "sm2"
+    pass_grade = int(os.getenv("SM2_PASS_GRADE", "4"))
+    fail_grade = int(os.getenv("SM2_FAIL_GRADE", "2"))
+    min_ease = 1.3
+    first_interval = 1.0
+    second_interval = 6.0
+
+    def review_batch(self, state, correct, elapsed_days):
+        grade = np.where(correct, self.pass_grade, self.fail_grade)
+        ease = state['ease'] + (0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02))
+        ease = np.maximum(ease, self.min_ease)
+        level = np.where(correct, state['level'] + 1, 0)
+        lapses = state['lapses'] + ((~correct) & (state['level'] > 0))
+        new_state = dict(state, level=level, ease=ease, lapses=lapses)
+        new_state['stability'] = self.interval_days(new_state)
+        return new_state
+
+    def interval_days(self, state):
+        level = state['level']
+        ease = state['ease']
+        # I(1) = 1, I(2) = 6, I(n) = I(n-1) * EF, written in closed form for the current EF
+        later = self.second_interval * np.power(ease, np.clip(level - 2, 0, None).astype(np.float64))
+        return np.select(
+            [level <= 0, level == 1, level == 2],
+            [0.0, self.first_interval, self.second_interval],
+            np.minimum(later, MAX_INTERVAL_DAYS),
+        )
+
+
+class FSRSScheduler(Scheduler):
+    """FSRS-4.5 with "I know it" as Good and "I forgot" as Again"""
+
+    name = "fsrs"
+    DECAY = -0.5
+    FACTOR = 19 / 81
+    DEFAULT_WEIGHTS = (
+        0.4872, 1.4003, 3.7145, 13.8206, 5.1618, 1.2298, 0.8975, 0.031, 1.6474,
+        0.1367, 1.0461, 2.1072, 0.0793, 0.3246, 1.587, 0.2272, 2.8755,
+    )
+    AGAIN, GOOD = 1, 3
+
+    def __init__(self, weights=None, desired_retention=None):
+        self.w = np.array(weights or self.DEFAULT_WEIGHTS, dtype=np.float64)
+        self.desired_retention = desired_retention or FSRS_DESIRED_RETENTION
+
+    def retrievability(self, elapsed_days, stability):
+        return np.power(1 + self.FACTOR * elapsed_days / stability, self.DECAY)
+
+    def initial_difficulty(self, grade):
+        return np.clip(self.w[4] - (grade - 3) * self.w[5], 1, 10)
+
+    def review_batch(self, state, correct, elapsed_days):
+        w = self.w
+        grade = np.where(correct, self.GOOD, self.AGAIN)
+        stability = state['stability']
+        difficulty = state['difficulty']
+        # Cards without a usable stability (new, or last scheduled by another scheduler after a miss)
+        is_new = np.isnan(stability) | (stability <= 0)
+
+        # They start from the initial values for their first grade
+        safe_stability = np.where(is_new, 1.0, stability)
+        safe_difficulty = np.where(np.isnan(difficulty), self.initial_difficulty(grade), difficulty)
+        r = self.retrievability(np.maximum(elapsed_days, 0), safe_stability)
+
+        recall_stability = safe_stability * (
+            1 + np.exp(w[8]) * (11 - safe_difficulty) * np.power(safe_stability, -w[9])
+            * (np.exp(w[10] * (1 - r)) - 1)
+        )
+        forget_stability = (
+            w[11] * np.power(safe_difficulty, -w[12]) * (np.power(safe_stability + 1, w[13]) - 1)
+            * np.exp(w[14] * (1 - r))
+        )
+        new_stability = np.where(correct, recall_stability, np.minimum(forget_stability, safe_stability))
+        new_stability = np.where(is_new, w[grade - 1], new_stability)
+
+        next_difficulty = safe_difficulty - w[6] * (grade - 3)
+        next_difficulty = w[7] * self.initial_difficulty(self.GOOD) + (1 - w[7]) * next_difficulty
+        new_difficulty = np.where(is_new, self.initial_difficulty(grade), np.clip(next_difficulty, 1, 10))
+
+        level = np.where(correct, state['level'] + 1, 0)
+        lapses = state['lapses'] + ((~correct) & (state['level'] > 0))
+        return dict(state, level=level, stability=new_stability, difficulty=new_difficulty, lapses=lapses)
+
+    def interval_days(self, state):
+        stability = np.where(np.isnan(state['stability']), 0.0, state['stability'])
+        interval = stability / self.FACTOR * (np.power(self.desired_retention, 1 / self.DECAY) - 1)
+        # Forgotten cards come back in the same session
+        return np.where(state['level'] <= 0, 0.0, np.maximum(np.round(interval), 1.0))
+
+
+SCHEDULERS = {cls.name: cls for cls in (LadderScheduler, SM2Scheduler, FSRSScheduler)}
+
+_instances = {}
+
+
+def get_scheduler(name=None):
+    name = (name or SCHEDULER).lower()
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler '{name}', expected one of: {', '.join(SCHEDULERS)}")
+    if name not in _instances:
+        _instances[name] = SCHEDULERS[name]()
+    return _instances[name]
+
+
+def reschedule_rows(scheduler, rows):
+    """
+    New due dates for a chunk of word rows (id, repetition_level, ease, stability,
+    difficulty, lapses, last_review_at, stability_scale), as (id, last_review_at,
+    next_review_at). A row's scale is its user's own fit; None falls back to the
+    scheduler's global one, as in live reviews.
+    """
+    ids, levels, eases, stabilities, difficulties, lapses, last_reviews, scales = zip(*rows)
+    state = {
+        'level': np.array(levels, dtype=np.int64),
+        'ease': np.array(eases, dtype=np.float64),
+        'stability': np.array([np.nan if v is None else v for v in stabilities], dtype=np.float64),
+        'difficulty': np.array([np.nan if v is None else v for v in difficulties], dtype=np.float64),
+        'lapses': np.array(lapses, dtype=np.int64),
+    }
+    scale = np.array([scheduler.stability_scale if v is None else v for v in scales], dtype=np.float64)
+    due = scheduler.due_dates(state, np.array(last_reviews, dtype='datetime64[us]'), scale)
+    return list(zip(ids, last_reviews, due.astype(object)))
+
+
 def calculate_next_review(current_level: int, is_correct: bool):
     """
     Calculates the next review interval based on a simplified spaced repetition algorithm.
-    
+
     Levels correspond roughly to:
     0: New
     1: 1 day
@@ -13,25 +268,5 @@ def calculate_next_review(current_level: int, is_correct: bool):
     5: 30 days
     ...
     """
-    if not is_correct:
-        # If incorrect, reset progress or stay at 0
-        new_level = 0
-        interval_days = 0 # Review immediately/soon means we treat it as "new" technically, 
-                          # but effectively for the user flow we might want it back in the queue soon.
-                          # For simplicity here: 0 days (due now)
-    else:
-        new_level = current_level + 1
-        if new_level == 1:
-            interval_days = 1
-        elif new_level == 2:
-            interval_days = 3
-        elif new_level == 3:
-            interval_days = 7
-        elif new_level == 4:
-            interval_days = 14
-        else:
-            # Simple exponential growth for higher levels
-            interval_days = 30 * (2 ** (new_level - 5))
-            
-    next_review_date = datetime.now() + timedelta(days=interval_days)
-    return new_level, next_review_date
+    state = LadderScheduler().review({'level': current_level}, is_correct)
+    return state['level'], state['next_review_at']
@@ -0,0 +1,6 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# ai_client builds its client at import; these tests never call a model
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
@@ -0,0 +1,19 @@
+import definition_jobs
+import definition_format
+
+
+def test_bold_escapes_special_characters_outside_the_entity():
+    assert definition_format.bold("well_known") == "*well*\\_*known*"
+    assert definition_format.bold("a*b") == "*a*\\**b*"
+    assert definition_format.bold("_x_") == "\\_*x*\\_"
+    assert definition_format.bold("plain") == "*plain*"
+
+
+def test_saved_word_title_has_no_escapes_inside_bold():
+    entry = definition_format.from_columns("a widely known thing")
+    text = definition_jobs.format_saved_word("well_known", entry)
+    assert text.startswith("📖 *well*\\_*known*\n\n")
+    # Every bold entity closes before an escape
+    title = text.split("\n", 1)[0]
+    for entity in title.split("*")[1::2]:
+        assert "\\" not in entity
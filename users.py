@@ -0,0 +1,75 @@
+"""
+Known users and their settings, cached in process.
+
+Adding a word adds its user in the same statement, so the common path never
+writes to users separately. Handlers that need the user row without saving
+a word call ensure_user, which only goes to the database for users this
+process has not seen yet.
+
+Settings are a JSON object in users.settings, merged over DEFAULT_SETTINGS.
+update_settings refreshes this process's copy. Copies in other processes
+expire after USER_SETTINGS_TTL. In the multi-worker setup a user's updates
+always reach the same worker, so that worker's copy is always current.
+"""
+import json
+import os
+
+import database
+from definitions import LRUCache
+
+# Users whose existence and settings are remembered per process
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))
+# Seconds cached settings are trusted, for changes made by other processes
+USER_SETTINGS_TTL = float(os.getenv("USER_SETTINGS_TTL", "300"))
+
+# Users are never deleted, the TTL only bounds how long a stale entry could linger
+KNOWN_USER_TTL = 24 * 3600
+
+# Values of settings a user never changed (database.claim_reminders assumes the same default)
+DEFAULT_SETTINGS = {
+    "reminders": True,
+}
+
+_known = LRUCache(USER_CACHE_SIZE, KNOWN_USER_TTL)
+_settings = LRUCache(USER_CACHE_SIZE, USER_SETTINGS_TTL)
+
+
+async def ensure_user(user_id):
+    """Make sure the user has a row in users, without a query once this process has seen them"""
+    if _known.get(user_id) is None:
+        await database.add_user(user_id)
+        _known.set(user_id, True)
+
+
+def mark_known(user_id):
+    """Remember a user that some other statement (e.g. add_word) has already added"""
+    _known.set(user_id, True)
+
+
+def _merged(settings_json):
+    return {**DEFAULT_SETTINGS, **json.loads(settings_json or "{}")}
+
+
+async def get_settings(user_id):
+    """A user's settings with defaults filled in (a copy, changes go through update_settings)"""
+    settings = _settings.get(user_id)
+    if settings is None:
+        stored = await database.get_user_settings(user_id)
+        if stored is not None:
+            mark_known(user_id)
+        settings = _merged(stored)
+        _settings.set(user_id, settings)
+    return dict(settings)
+
+
+async def update_settings(user_id, **changes):
+    """Change some of a user's settings; returns all of them"""
+    settings = _merged(await database.update_user_settings(user_id, json.dumps(changes)))
+    mark_known(user_id)
+    _settings.set(user_id, settings)
+    return dict(settings)
+
+
+def invalidate(user_id):
+    """Forget a user's cached settings, e.g. after changing them with a direct query"""
+    _settings.delete(user_id)
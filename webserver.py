@@ -0,0 +1,127 @@
+"""
+Webhook mode: Telegram pushes updates to an aiohttp server instead of the bot
+long-polling for them.
+
+    POST {WEBHOOK_PATH}   updates from Telegram, checked against WEBHOOK_SECRET
+    GET  /healthz         200 while serving, 503 while draining on shutdown
+
+On SIGTERM/SIGINT the server starts answering 503 so Telegram keeps the
+remaining updates and redelivers them, then waits for the handlers that are
+already running before shutting the application down.
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import signal
+
+from aiohttp import web
+from telegram import Update
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip('/')
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Railway and most PaaS hosts tell the app which port to listen on
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+# Parallel connections Telegram may open to deliver updates (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+logger = logging.getLogger(__name__)
+
+APPLICATION_KEY = web.AppKey("application", object)
+STATE_KEY = web.AppKey("state", dict)
+
+
+def secret_token(bot_token):
+    """WEBHOOK_SECRET, or a stable secret derived from the bot token so all instances agree"""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{bot_token}".encode("utf-8")).hexdigest()
+
+
+async def telegram_webhook(request):
+    application = request.app[APPLICATION_KEY]
+    state = request.app[STATE_KEY]
+
+    received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(received, state["secret"]):
+        return web.Response(status=403)
+
+    if state["draining"]:
+        # Telegram retries later, by then another instance (or this one after restart) takes it
+        return web.Response(status=503)
+
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception:
+        logger.warning("Rejected malformed update", exc_info=True)
+        return web.Response(status=400)
+
+    await application.update_queue.put(update)
+    return web.Response()
+
+
+async def healthz(request):
+    state = request.app[STATE_KEY]
+    if state["draining"]:
+        return web.json_response({"status": "draining"}, status=503)
+    return web.json_response({"status": "ok"})
+
+
+def make_app(application, state):
+    app = web.Application()
+    app[APPLICATION_KEY] = application
+    app[STATE_KEY] = state
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+async def run_webhook(application):
+    """Serve updates over a webhook until SIGTERM/SIGINT, then drain and shut down"""
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL is required in webhook mode, e.g. https://my-bot.up.railway.app")
+
+    state = {"draining": False, "secret": secret_token(application.bot.token)}
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    runner = web.AppRunner(make_app(application, state), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    # Only ask Telegram to push once we can accept updates; keep its queue across restarts
+    await application.bot.set_webhook(
+        url=WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=state["secret"],
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=False,
+    )
+    print(f"Bot is running (webhook on port {WEBHOOK_PORT})...")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Shutting down: draining in-flight updates")
+        state["draining"] = True
+        # Finish the updates already queued and the handlers that are running
+        if application.running:
+            await application.stop()
+        await runner.cleanup()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
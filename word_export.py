@@ -0,0 +1,82 @@
+"""
+/export of a user's vocabulary.
+
+Words are read in chunks through a server-side cursor and written straight
+to a text stream (a temporary file in the bot), so memory use stays flat no
+matter how many words a user has.
+
+    csv    word, definition, level and dates, with a header row
+    json   array of objects with the same fields
+    anki   tab-separated notes (Front/Back) for File > Import in Anki
+"""
+import csv
+import html
+import json
+
+import database
+import definition_format
+
+# Rows fetched from the cursor at a time
+EXPORT_CHUNK_SIZE = 500
+
+FORMATS = ("csv", "json", "anki")
+FILE_EXTENSIONS = {"csv": "csv", "json": "json", "anki": "txt"}
+
+FIELDS = ["word", "definition", "repetition_level", "next_review_at", "created_at"]
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def _as_dict(row):
+    return {
+        "word": row['word'],
+        "definition": _definition(row),
+        "repetition_level": row['repetition_level'],
+        "next_review_at": _isoformat(row['next_review_at']),
+        "created_at": _isoformat(row['created_at']),
+    }
+
+
+def _definition(row):
+    # Rendered the way the bot shows it, without Markdown
+    return definition_format.render(definition_format.from_row(row), markdown=False)
+
+
+def _anki_field(text):
+    # Anki reads the fields as HTML; tabs would split the note
+    return html.escape(text or "").replace("\t", " ").replace("\r\n", "<br>").replace("\n", "<br>")
+
+
+async def write_words(user_id, fmt, out):
+    """Write a user's words in the given format to a text stream, return how many were written"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    count = 0
+    writer = csv.writer(out) if fmt == "csv" else None
+    if fmt == "csv":
+        writer.writerow(FIELDS)
+    elif fmt == "json":
+        out.write("[")
+    else:
+        out.write("#separator:tab\n#html:true\n#columns:Front\tBack\n")
+
+    async for rows in database.iter_user_words(user_id, EXPORT_CHUNK_SIZE):
+        for row in rows:
+            if fmt == "csv":
+                writer.writerow([
+                    row['word'], _definition(row), row['repetition_level'],
+                    _isoformat(row['next_review_at']), _isoformat(row['created_at']),
+                ])
+            elif fmt == "json":
+                out.write(",\n" if count else "\n")
+                out.write(json.dumps(_as_dict(row), ensure_ascii=False))
+            else:
+                out.write(f"{_anki_field(row['word'])}\t{_anki_field(_definition(row))}\n")
+            count += 1
+
+    if fmt == "json":
+        out.write("\n]\n")
+    return count
@@ -0,0 +1,110 @@
+"""
+Bulk import of words for /import.
+
+Words come one per line (or as the first column of a CSV file). Duplicates
+and words the user already has are dropped, cached definitions are reused,
+the rest are fetched with at most IMPORT_CONCURRENCY lookups at a time and
+everything is inserted with a single statement. Words no model could define
+right away are left to the background definition jobs.
+"""
+import asyncio
+import csv
+import io
+import os
+import time
+from datetime import datetime
+
+import ai_client
+import database
+import definition_format
+import definition_jobs
+import definitions
+import users
+import word_search
+
+# Most words accepted in one import
+IMPORT_MAX_WORDS = int(os.getenv("IMPORT_MAX_WORDS", "500"))
+# Model lookups running at once for one import
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "8"))
+# Largest uploaded file accepted, bytes
+IMPORT_MAX_FILE_SIZE = int(os.getenv("IMPORT_MAX_FILE_SIZE", str(256 * 1024)))
+# Seconds between progress message edits
+IMPORT_PROGRESS_INTERVAL = 2.0
+
+MAX_WORD_LENGTH = 100
+
+
+def parse_words(text):
+    """Words from pasted text or a CSV/TXT file: the first field of every line, first occurrence kept"""
+    words = {}
+    for row in csv.reader(io.StringIO(text)):
+        if not row:
+            continue
+        word = " ".join(row[0].split())
+        if not word or word.startswith('#') or len(word) > MAX_WORD_LENGTH:
+            continue
+        words.setdefault(definitions.normalize_word(word), word)
+    return list(words.values())
+
+
+async def import_words(user_id, words, progress=None):
+    """
+    Save words for a user. progress(done, total) is awaited now and then while
+    definitions are fetched. Returns counts of added, already known and
+    still pending words.
+    """
+    existing = await database.get_existing_words(user_id, words)
+    new_words = [word for word in words if word.lower() not in existing]
+    found = await definitions.cached_many(new_words)
+
+    results = {}
+    to_fetch = []
+    for word in new_words:
+        cached = found.get(definitions.normalize_word(word))
+        if cached is not None:
+            results[word] = cached
+        else:
+            to_fetch.append(word)
+
+    semaphore = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    done = 0
+    last_report = time.monotonic()
+
+    async def fetch(word):
+        nonlocal done, last_report
+        async with semaphore:
+            try:
+                results[word] = await definitions.lookup(word)
+            except Exception:
+                # The background job will try again
+                results[word] = (None, None)
+        done += 1
+        if progress is not None and time.monotonic() - last_report >= IMPORT_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await progress(done, len(to_fetch))
+
+    # Bulk lookups yield model slots to users waiting for a single word
+    with ai_client.priority(ai_client.BACKGROUND):
+        await asyncio.gather(*(fetch(word) for word in to_fetch))
+
+    rows = []
+    for word in new_words:
+        definition_id, entry = results[word]
+        if definition_id is None:
+            entry = definition_format.from_columns(definition_jobs.PENDING_DEFINITION)
+        definition, details = definition_format.to_columns(entry)
+        rows.append((word, definition, definition_id, details))
+
+    inserted = await database.add_words(user_id, rows, datetime.now()) if rows else []
+    if inserted:
+        # add_words added the user as well
+        users.mark_known(user_id)
+        word_search.invalidate(user_id)
+    pending = [(row['id'], row['word']) for row in inserted if row['definition_id'] is None]
+    await definition_jobs.enqueue_many(pending)
+
+    return {
+        "added": len(inserted),
+        "existing": len(words) - len(inserted),
+        "pending": len(pending),
+    }
@@ -0,0 +1,173 @@
+"""
+/search over a user's vocabulary, tolerant to typos.
+
+Results are ranked: the exact word first, then words starting with the term,
+then words containing it, then similar words ("recieve" finds "receive").
+With SEARCH_BACKEND=auto the pg_trgm indexes are used when the extension is
+installed, otherwise a compact in-process index per user:
+
+    keys      lowercased words, sorted (prefixes by binary search)
+    postings  trigram -> positions of the words containing it (int32 arrays)
+
+Candidates are counted with np.bincount over the postings of the term's
+trigrams and the best of them are re-ranked by edit distance. An index is
+dropped when the user adds or deletes words (invalidate) and expires after
+SEARCH_INDEX_TTL anyway, e.g. for words added by another process.
+Definitions are always searched in Postgres, they are too big to keep here.
+"""
+import asyncio
+import logging
+import os
+from bisect import bisect_left
+
+import numpy as np
+
+import database
+from definitions import LRUCache, normalize_word
+
+# auto (pg_trgm if installed), postgres or memory
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "auto").lower()
+# Results shown per search
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", "10"))
+# Users whose in-memory index is kept, and for how many seconds
+SEARCH_INDEX_USERS = int(os.getenv("SEARCH_INDEX_USERS", "1000"))
+SEARCH_INDEX_TTL = float(os.getenv("SEARCH_INDEX_TTL", "600"))
+
+# Least trigram similarity of a fuzzy match (pg_trgm's default threshold)
+MIN_SIMILARITY = 0.3
+# Words sharing the most trigrams with the term that are checked by edit distance
+FUZZY_CANDIDATES = 200
+
+logger = logging.getLogger(__name__)
+
+_indexes = LRUCache(SEARCH_INDEX_USERS, SEARCH_INDEX_TTL)
+_use_trgm = None
+
+
+def trigrams(text):
+    """Trigrams of a lowercased word, padded like pg_trgm does"""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b):
+    """Levenshtein distance counting a swap of two neighbouring letters as one edit"""
+    previous2, previous = None, list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def max_typos(term):
+    return 1 if len(term) < 6 else 2
+
+
+class WordIndex:
+    """In-memory search index of one user's words"""
+
+    def __init__(self, entries):
+        entries = sorted((normalize_word(row['word']), row['id']) for row in entries)
+        self.keys = [key for key, _ in entries]
+        self.ids = np.array([word_id for _, word_id in entries], dtype=np.int64)
+
+        postings = {}
+        self.trigram_counts = np.empty(len(self.keys), dtype=np.int32)
+        for position, key in enumerate(self.keys):
+            grams = trigrams(key)
+            self.trigram_counts[position] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(position)
+        self.postings = {gram: np.array(positions, dtype=np.int32) for gram, positions in postings.items()}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, term, limit):
+        """Ids of the best matches with their scores, best first"""
+        scores = {}
+
+        # Exact match and prefixes: 2 < score <= 3, shorter completions first
+        start = bisect_left(self.keys, term)
+        end = bisect_left(self.keys, term + "\uffff", lo=start)
+        for position in range(start, min(end, start + limit)):
+            scores[position] = 2.0 + len(term) / len(self.keys[position])
+
+        # Substrings (1 < score < 2) and similar words (score <= 1) among those sharing most trigrams
+        grams = trigrams(term)
+        lists = [self.postings[gram] for gram in grams if gram in self.postings]
+        if lists and len(scores) < limit:
+            shared = np.bincount(np.concatenate(lists), minlength=len(self.keys))
+            candidates = np.flatnonzero(shared)
+            if len(candidates) > FUZZY_CANDIDATES:
+                candidates = candidates[np.argpartition(shared[candidates], -FUZZY_CANDIDATES)[-FUZZY_CANDIDATES:]]
+            similarity = shared[candidates] / (len(grams) + self.trigram_counts[candidates] - shared[candidates])
+
+            for position, sim in zip(candidates.tolist(), similarity.tolist()):
+                if position in scores:
+                    continue
+                key = self.keys[position]
+                if term in key:
+                    scores[position] = 1.0 + len(term) / len(key)
+                    continue
+                distance = edit_distance(term, key) if abs(len(key) - len(term)) <= max_typos(term) else None
+                if distance is not None and distance <= max_typos(term):
+                    scores[position] = max(sim, 1.0 - distance / max(len(term), len(key)))
+                elif sim >= MIN_SIMILARITY:
+                    scores[position] = sim
+
+        best = sorted(scores.items(), key=lambda item: (-item[1], self.keys[item[0]]))[:limit]
+        return [(int(self.ids[position]), score) for position, score in best]
+
+
+def invalidate(user_id):
+    """Forget a user's index after their words changed"""
+    _indexes.delete(user_id)
+
+
+async def _index_for(user_id):
+    index = _indexes.get(user_id)
+    if index is None:
+        entries = await database.get_search_entries(user_id)
+        # About a second for 100k words: keep the event loop free meanwhile
+        index = await asyncio.to_thread(WordIndex, entries)
+        _indexes.set(user_id, index)
+    return index
+
+
+async def _uses_trgm():
+    global _use_trgm
+    if _use_trgm is None:
+        if SEARCH_BACKEND == "memory":
+            _use_trgm = False
+        else:
+            _use_trgm = await database.has_extension("pg_trgm")
+            if not _use_trgm and SEARCH_BACKEND == "postgres":
+                logger.warning("SEARCH_BACKEND=postgres but pg_trgm is not installed, using the in-memory index")
+    return _use_trgm
+
+
+async def search(user_id, term, in_definitions=False, limit=SEARCH_LIMIT):
+    """
+    Word rows (id, word, repetition_level) matching the term, best first; with
+    in_definitions, words whose definition mentions it come last. Definitions are
+    not included, see main.word_definition
+    """
+    term = normalize_word(term)
+    if await _uses_trgm():
+        results = list(await database.search_words_fuzzy(user_id, term, limit))
+    else:
+        ranked = (await _index_for(user_id)).search(term, limit)
+        rows = {row['id']: row for row in await database.get_words_by_ids(user_id, [i for i, _ in ranked])}
+        results = [rows[word_id] for word_id, _ in ranked if word_id in rows]
+
+    if in_definitions and len(results) < limit:
+        found = {row['id'] for row in results}
+        for row in await database.search_definitions(user_id, term, limit):
+            if row['id'] not in found and len(results) < limit:
+                results.append(row)
+    return results